@@ -11,23 +11,94 @@ Example usage:
     Extract Markup from an image of a Paper2GIS layout:
         `python p2g.py extract --reference out.png --target ./data/IMG_9441.jpg -o ./out/path.tif --threshold 100 --kernel 0`
         `python p2g.py extract --reference out.png --target ./data/IMG_9441.jpg -o ./out/path.tif --threshold 100 --kernel 0 --verbose`
+
+    Extract Markup from the best 3 frames of a burst of photographs (or a video):
+        `python p2g.py extract --reference out.png --target ./data/burst/ -o ./out/path.shp --best 3`
+
+    Extract Markup from every photograph in a folder (skipping any that are already up to date):
+        `python p2g.py batch --reference out.png --target ./data/ -o ./out/`
+
+    Share extraction between several machines using a queue on a shared drive:
+        `python p2g.py enqueue --queue /shared/jobs.db --reference /shared/out.png --target /shared/data/ -o /shared/out/`
+        `python p2g.py worker --queue /shared/jobs.db` (on each machine)
+        `python p2g.py status --queue /shared/jobs.db`
 """
 
 # import argparser
 from argparse import ArgumentParser
 from warnings import catch_warnings, simplefilter as warn_filter
 
+
+def extract_params(args):
+    """
+    * Get the extraction parameters (as keyword arguments for run_extract) from the parsed arguments
+    """
+    return dict(lowe_distance=args.lowe_distance, thresh=args.threshold, kernel=args.kernel,
+        homo_matches=args.homo_matches, frame=args.frame, min_area=args.min_area, 
+        min_ratio=args.min_ratio, buffer=args.buffer, uid=args.uid, 
+        convex_hull=args.convex_hull=='True', centroid=args.centroid=='True', 
+        representative_point=args.representative_point=='True', exterior=args.exterior=='True',
+        interior=args.interior=='True', holes=args.holes, engine=args.engine, approx=args.approx,
+        simplify=args.simplify, simplify_units=args.simplify_units, precision=args.precision,
+        working_dpi=args.working_dpi)
+
+
 # ignore warnings
 with catch_warnings():
     warn_filter("ignore")
 
     # set up argument parser
     parser = ArgumentParser("Paper2GIS")
-    subparsers = parser.add_subparsers(help="either: 'generate' to make a Paper2GIS layout; 'extract' to retrieve markup from a photograph of a used Paper2GIS layout; or 'test' to test that a new installation is functioning", dest='command')
+    subparsers = parser.add_subparsers(help="either: 'generate' to make a Paper2GIS layout; 'extract' to retrieve markup from a photograph of a used Paper2GIS layout; 'batch' to extract markup from a folder of photographs; 'enqueue', 'worker' and 'status' to share extraction between machines using a queue; or 'test' to test that a new installation is functioning", dest='command')
+
+    # options shared by everything that extracts markup
+    extract_options = ArgumentParser(add_help=False)
+
+    # for the extraction process
+    extract_options.add_argument('-l','--lowe_distance', type=float, help='the lowe distance threshold', required = False, default=0.5)
+    extract_options.add_argument('-k','--kernel', type=int, help='the size of the kernel used for opening the image', required = False, default=3)
+    extract_options.add_argument('-i','--threshold', type=int, help='the threshold the target image', required = False, default=100)
+    extract_options.add_argument('-m','--homo_matches', type=int, help='the number of matches required for homography', required = False, default=12)
+    extract_options.add_argument('-w','--working_dpi', type=int, help='the resolution (dpi) at which to extract the map (default: the resolution of the layout)', required = False, default=None)
+    
+    # add user id to the output shapefile
+    extract_options.add_argument('-u','--uid', type=int, help='user ID number to add the the output shapefile', required = False)
+
+    # TODO: perhaps also make this happen automatically if not enough matches are found? Need to experiment...
+    extract_options.add_argument('-f','--frame', type=float, help='a frame to add round the image if the map is too close to the edge', required = False, default=0)
+
+    # for vector data cleaning
+    extract_options.add_argument('-a','--min_area', type=float, help='the area below which features will be rejected', required = False, default = 1000)
+    extract_options.add_argument('-x','--min_ratio', type=float, help='the ratio (long/short) below which features will be rejected', required = False, default = 0.2)
+    extract_options.add_argument('-b','--buffer', type=float, help='buffer around the edge used for data cleaning', required = False, default = 10)
+
+    # for vector output - do you want a convex hull or not?
+    extract_options.add_argument('-cc','--convex_hull', action='store_true', help='store convex hulls of extracted shapes?', required = False, default = 'False')
+    extract_options.add_argument('-cx','--centroid', action='store_true', help='store centroids of extracted shapes?', required = False, default = 'False')
+    extract_options.add_argument('-cr','--representative_point', action='store_true', help='store representative points of extracted shapes?', required = False, default = 'False')
+    extract_options.add_argument('-ce','--exterior', action='store_true', help='extract polygons from boundaries by extracting the outer ring', required = False, default = 'False')
+    extract_options.add_argument('-ci','--interior', action='store_true', help='extract polygons from boundaries by extracting the inner rings', required = False, default = 'False')
+    extract_options.add_argument('-ch','--holes', action='store_true', help='extract polygons from boundaries, where boundaries drawn inside another boundary become holes', required = False, default = False)
+
+    # vectorisation
+    extract_options.add_argument('-vg','--engine', choices=['shapes', 'contours'], help='the vectorisation engine: rasterio shapes (default) or OpenCV contours', required = False, default = 'shapes')
+    extract_options.add_argument('-vp','--approx', type=float, help='simplification tolerance in pixels for the contours engine (default: 0 - no simplification)', required = False, default = 0)
+
+    # for vector output simplification
+    extract_options.add_argument('-s','--simplify', type=float, help='simplify the output features: the maximum distance that an outline can move (default: 0 - no simplification)', required = False, default = 0)
+    extract_options.add_argument('-su','--simplify_units', choices=['map', 'pixels'], help='the units of --simplify (default: map units)', required = False, default = 'map')
+    extract_options.add_argument('-sp','--precision', type=float, help='snap output coordinates to a grid of this size in map units (default: 0 - no snapping)', required = False, default = 0)
+
+    # verbose mode
+    extract_options.add_argument('-v','--verbose', action='store_true', help='enable verbose output', required=False, default=False)
 
     # create subparsers
     g2p_parser = subparsers.add_parser("generate")
-    p2g_parser = subparsers.add_parser("extract")
+    p2g_parser = subparsers.add_parser("extract", parents=[extract_options])
+    batch_parser = subparsers.add_parser("batch", parents=[extract_options])
+    enqueue_parser = subparsers.add_parser("enqueue", parents=[extract_options])
+    worker_parser = subparsers.add_parser("worker")
+    status_parser = subparsers.add_parser("status")
     test_parser = subparsers.add_parser("test")
 
 
@@ -39,7 +110,7 @@ with catch_warnings():
     g2p_parser.add_argument('-c','--tr_x', help='top right x coord', required = True)
     g2p_parser.add_argument('-d','--tr_y', help='top right y coord', required = True)
     g2p_parser.add_argument('-e','--epsg', help='EPSG code for the map CRS', required=False, default='3857')
-    g2p_parser.add_argument('-r','--resolution', type=int, help='Resolution of the input map image (dpi)', required=False, default='96')
+    g2p_parser.add_argument('-r','--resolution', type=int, help='Resolution of the layout and the input map image (dpi)', required=False, default='96')
 
     # path to the map input (this or tiles=True is required)
     g2p_parser.add_argument('-i','--input', help='the input map image (file path) - this is ignored if --tiles=True', required=False, default='map.png')
@@ -53,6 +124,7 @@ with catch_warnings():
     g2p_parser.add_argument('-z','--zoom', type=int, help='requested zoom level of OSM tiles (necessary if using tiles)', required=False, default=0)
     g2p_parser.add_argument('-s','--hillshade', action='store_true', help='add hillshade to generated OSM map', required=False, default='False')
     g2p_parser.add_argument('-sa','--hillshadealpha', type=float, help='the alpha value for the hillshade layer', required=False, default=0.25)
+    g2p_parser.add_argument('-tw','--tileworkers', type=int, help='the number of map tiles to download concurrently', required=False, default=8)
     
     # boundary dataset
     g2p_parser.add_argument('-bf','--boundaryfile', help='a shapefile containing boundary data', required=False, default=None)
@@ -70,34 +142,46 @@ with catch_warnings():
     p2g_parser.add_argument('-r','--reference', help='the reference image', required = True)
     p2g_parser.add_argument('-t','--target', help='the target image', required = True)
     p2g_parser.add_argument('-o','--output', help='the name of the output file', required = False, default='out.shp')
-    p2g_parser.add_argument('-l','--lowe_distance', type=float, help='the lowe distance threshold', required = False, default=0.5)
-    p2g_parser.add_argument('-k','--kernel', type=int, help='the size of the kernel used for opening the image', required = False, default=3)
-    p2g_parser.add_argument('-i','--threshold', type=int, help='the threshold the target image', required = False, default=100)
-    p2g_parser.add_argument('-m','--homo_matches', type=int, help='the number of matches required for homography', required = False, default=12)
-    
-    # add user id to the output shapefile
-    p2g_parser.add_argument('-u','--uid', type=int, help='user ID number to add the the output shapefile', required = False)
-
-    # TODO: perhaps also make this happen automatically if not enough matches are found? Need to experiment...
-    p2g_parser.add_argument('-f','--frame', type=float, help='a frame to add round the image if the map is too close to the edge', required = False, default=0)
-
-    # for vector data cleaning
-    p2g_parser.add_argument('-a','--min_area', type=float, help='the area below which features will be rejected', required = False, default = 1000)
-    p2g_parser.add_argument('-x','--min_ratio', type=float, help='the ratio (long/short) below which features will be rejected', required = False, default = 0.2)
-    p2g_parser.add_argument('-b','--buffer', type=float, help='buffer around the edge used for data cleaning', required = False, default = 10)
 
-    # for vector output - do you want a convex hull or not?
-    p2g_parser.add_argument('-cc','--convex_hull', action='store_true', help='store convex hulls of extracted shapes?', required = False, default = 'False')
-    p2g_parser.add_argument('-cx','--centroid', action='store_true', help='store centroids of extracted shapes?', required = False, default = 'False')
-    p2g_parser.add_argument('-cr','--representative_point', action='store_true', help='store representative points of extracted shapes?', required = False, default = 'False')
-    p2g_parser.add_argument('-ce','--exterior', action='store_true', help='extract polygons from boundaries by extracting the outer ring', required = False, default = 'False')
-    p2g_parser.add_argument('-ci','--interior', action='store_true', help='extract polygons from boundaries by extracting the inner rings', required = False, default = 'False')
+    # pre-screen for bursts of photographs (a folder passed as --target) or videos
+    p2g_parser.add_argument('-n','--best', type=int, help='the number of frames to extract from a burst folder or video', required = False, default = 3)
+    p2g_parser.add_argument('-qs','--min_sharpness', type=float, help='frames below this sharpness (variance of the Laplacian) are skipped', required = False, default = 0)
+    p2g_parser.add_argument('-qc','--min_contrast', type=float, help='frames below this contrast (0-1) are skipped', required = False, default = 0)
+    p2g_parser.add_argument('-qf','--frame_step', type=int, help='only pre-screen every nth frame of a video', required = False, default = 1)
 
     # runtime settings
     p2g_parser.add_argument('-d','--demo', action='store_true', help='the output data file', required = False, default = 'False')
-    
-    # verbose mode
-    p2g_parser.add_argument('-v','--verbose', action='store_true', help='enable verbose output', required=False, default=False)
+
+
+    ''' SET UP ARGS FOR BATCH '''
+
+    batch_parser.add_argument('-r','--reference', help='the reference image', required = True)
+    batch_parser.add_argument('-t','--target', help='the folder of photographs', required = True)
+    batch_parser.add_argument('-o','--output', help='the folder for the output files (default: the folder of photographs)', required = False, default=None)
+    batch_parser.add_argument('-e','--extension', help='the type of output file (.shp or .tif)', required = False, default='.shp')
+    batch_parser.add_argument('-n','--workers', type=int, help='the number of photographs to extract at once (in threads)', required = False, default=1)
+    batch_parser.add_argument('-F','--force', action='store_true', help='re-extract every photograph, even if its output is up to date', required = False, default=False)
+
+
+    ''' SET UP ARGS FOR THE JOB QUEUE '''
+
+    # add jobs to a queue (a SQLite file on a shared drive)
+    enqueue_parser.add_argument('-q','--queue', help='the queue file (created if it does not exist)', required = True)
+    enqueue_parser.add_argument('-r','--reference', help='the reference image', required = True)
+    enqueue_parser.add_argument('-t','--target', nargs='+', help='the photographs and/or folders of photographs', required = True)
+    enqueue_parser.add_argument('-o','--output', help='the folder for the output files (default: alongside each photograph)', required = False, default=None)
+    enqueue_parser.add_argument('-e','--extension', help='the type of output file (.shp or .tif)', required = False, default='.shp')
+
+    # claim and run jobs from a queue
+    worker_parser.add_argument('-q','--queue', help='the queue file', required = True)
+    worker_parser.add_argument('-n','--name', help='the name of the worker (default: hostname:pid)', required = False, default=None)
+    worker_parser.add_argument('-L','--lease', type=float, help='the lease on a job (seconds) before it is re-queued if the worker stops', required = False, default=60)
+    worker_parser.add_argument('-p','--poll', type=float, help='how often to check for new jobs (seconds) when using --wait', required = False, default=10)
+    worker_parser.add_argument('-w','--wait', action='store_true', help='wait for new jobs when the queue is empty', required = False, default=False)
+    worker_parser.add_argument('-v','--verbose', action='store_true', help='enable verbose output', required=False, default=False)
+
+    # report the progress of a queue
+    status_parser.add_argument('-q','--queue', help='the queue file', required = True)
 
 
     ''' PARSE ARGS AND RUN '''
@@ -111,17 +195,44 @@ with catch_warnings():
         run_generate(args.bl_x, args.bl_y, args.tr_x, args.tr_y, args.epsg, 
             args.resolution, args.input, args.output, args.tiles == 'True', 
             args.fade, args.zoom, args.hillshade=='True', args.hillshadealpha, 
-            args.boundaryfile, args.boundarywidth, args.boundarycolour, args.boundaryalpha, args.verbose)
+            args.boundaryfile, args.boundarywidth, args.boundarycolour, args.boundaryalpha, args.verbose,
+            args.tileworkers)
 
     # extract markup from a photograph of a map and store the result in the specified file
     elif args.command == "extract":
         from paper2gis.paper2gis import run_extract
-        run_extract(args.reference, args.target, args.output, args.lowe_distance,
-            args.threshold, args.kernel, args.homo_matches, args.frame, args.min_area,
-            args.min_ratio, args.buffer, args.uid, args.convex_hull=='True', 
-            args.centroid=='True', args.representative_point=='True', 
-            args.exterior=='True', args.interior=='True', args.demo=='True', args.verbose)
+        from paper2gis.prescreen import is_burst, run_burst
+
+        # pre-screen a burst folder or video and only extract the best frames
+        if is_burst(args.target):
+            run_burst(args.reference, args.target, args.output, args.best, args.min_sharpness,
+                args.min_contrast, args.frame_step, args.verbose, demo=args.demo=='True', 
+                **extract_params(args))
+        else:
+            run_extract(args.reference, args.target, args.output, demo=args.demo=='True',
+                verbose=args.verbose, **extract_params(args))
+
+    # extract markup from every photograph in a folder that does not have an up to date output
+    elif args.command == "batch":
+        from paper2gis.batch import run_batch
+        run_batch(args.reference, args.target, args.output, args.extension, not args.force,
+            args.verbose, args.workers, **extract_params(args))
     
+    # add extraction jobs to a shared queue
+    elif args.command == "enqueue":
+        from paper2gis.jobqueue import run_enqueue
+        run_enqueue(args.queue, args.reference, args.target, args.output, args.extension, **extract_params(args))
+
+    # claim and run extraction jobs from a shared queue
+    elif args.command == "worker":
+        from paper2gis.jobqueue import run_worker
+        run_worker(args.queue, args.name, args.lease, args.poll, args.wait, args.verbose)
+
+    # report the progress of a shared queue
+    elif args.command == "status":
+        from paper2gis.jobqueue import run_status
+        run_status(args.queue)
+
     # run on test dataset, compare result to baseline and report
     elif args.command == "test":
         from PIL import Image, ImageChops
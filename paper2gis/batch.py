@@ -0,0 +1,201 @@
+"""
+* Resumable, incremental batch extraction for the Paper2GIS system
+*
+* Each output is recorded in a manifest alongside a hash of the photograph, the
+*  reference and the extraction parameters that made it, so that a rerun (e.g. after
+*  an interruption, or when new photographs have been added to the folder) only
+*  extracts the photographs whose outputs are missing or out of date. Every output is
+*  written to a temporary folder and then moved into place, so that a crash never
+*  leaves a half-written file behind.
+*
+* @author jonnyhuck
+"""
+
+from time import time
+from glob import glob, escape
+from json import dump, dumps, load
+from pathlib import Path
+from shutil import rmtree
+from hashlib import sha256
+from tempfile import mkdtemp
+from concurrent.futures import ThreadPoolExecutor
+from os import path, makedirs, replace, remove
+
+from paper2gis.context import RunContext, vprint
+from paper2gis.paper2gis import prepare_reference, run_extract, check_output_extension
+
+
+# the name of the manifest file in the output folder
+MANIFEST = ".p2g_manifest.json"
+
+# photograph types that are extracted (HEIC/HEIF are read directly)
+PHOTO_EXTENSIONS = {".jpg", ".jpeg", ".png", ".heic", ".heif"}
+
+# the prefix of the temporary folders that outputs are written to (see atomic_extract)
+TEMP_PREFIX = ".p2g-"
+
+# temporary folders that have not changed for this long (seconds) were left by a run that was killed
+STALE_TEMP_AGE = 600
+
+
+def file_hash(file_path):
+	"""
+	* Get the SHA-256 hash of the contents of a file
+	"""
+	h = sha256()
+	with open(file_path, 'rb') as f:
+		for block in iter(lambda: f.read(1 << 20), b''):
+			h.update(block)
+	return h.hexdigest()
+
+
+def job_hash(photo_hash, reference_hash, params):
+	"""
+	* Get a hash that identifies an output: the photograph, the reference and the
+	*  extraction parameters that were used to make it
+	"""
+	return sha256(dumps([photo_hash, reference_hash, params], sort_keys=True).encode()).hexdigest()
+
+
+def read_manifest(out_dir):
+	"""
+	* Read the manifest from an output folder (empty if there is not one yet)
+	"""
+	try:
+		with open(path.join(out_dir, MANIFEST)) as f:
+			return load(f)
+	except FileNotFoundError:
+		return {}
+
+
+def write_manifest(out_dir, manifest):
+	"""
+	* Write the manifest to an output folder, replacing the old one atomically
+	"""
+	tmp = path.join(out_dir, MANIFEST + ".tmp")
+	with open(tmp, 'w') as f:
+		dump(manifest, f, indent=1, sort_keys=True)
+	replace(tmp, path.join(out_dir, MANIFEST))
+
+
+def atomic_extract(reference, target, output, **kwargs):
+	"""
+	* Run an extraction into a temporary folder alongside the output, then move the
+	*  result (all of the files that make up a shapefile) into place. Additional keyword
+	*  arguments are passed to run_extract
+	* 
+	* If there is an old output, its main file is removed first and the new main file is
+	*  moved in last, so a crash part way through leaves the output missing (and so redone
+	*  by the next run) rather than new sidecar files next to an old .shp
+	"""
+	out_dir, name = path.split(path.abspath(output))
+	tmp_dir = mkdtemp(prefix=TEMP_PREFIX, dir=out_dir)
+	try:
+		run_extract(reference, target, path.join(tmp_dir, name), **kwargs)
+		main = path.join(tmp_dir, name)
+		files = glob(path.join(escape(tmp_dir), escape(Path(name).stem) + ".*"))
+
+		# remove the old main file before replacing any of its sidecars (e.g. .shx, .dbf)
+		if len(files) > 1 and path.exists(path.join(out_dir, name)):
+			remove(path.join(out_dir, name))
+
+		# move each file into place (the main file last, so it is only there when complete)
+		for f in sorted(files, key=lambda f: f == main):
+			replace(f, path.join(out_dir, path.basename(f)))
+	finally:
+		rmtree(tmp_dir, ignore_errors=True)
+
+
+def remove_stale_temp(out_dir, age=STALE_TEMP_AGE):
+	"""
+	* Remove the temporary folders left in an output folder by runs that were killed part
+	*  way through an extraction (e.g. by a power cut), which never get to tidy them up. Only
+	*  folders that have not changed for `age` seconds are removed, so that those of any
+	*  other run that is still writing to the same folder are left alone
+	* @return the number of folders that were removed
+	"""
+	removed = 0
+	for tmp_dir in glob(path.join(escape(out_dir), TEMP_PREFIX + "*")):
+		if path.isdir(tmp_dir) and time() - path.getmtime(tmp_dir) > age:
+			rmtree(tmp_dir, ignore_errors=True)
+			removed += 1
+	if removed:
+		vprint(f"Removed {removed} temporary folders left by an earlier run")
+	return removed
+
+
+def run_batch(reference, folder, out_dir=None, extension=".shp", incremental=True, verbose=False, workers=1, **kwargs):
+	"""
+	* Extract markup from every photograph in a folder, writing one output per photograph
+	*  (e.g. IMG_0001.jpg -> IMG_0001.shp). In incremental mode, photographs with an up to
+	*  date output are skipped. Photographs are extracted by a pool of `workers` threads, 
+	*  which share a single copy of the reference. Additional keyword arguments are 
+	*  passed to run_extract
+	* @author jonnyhuck
+	* @return a dict of the number of outputs that were extracted, skipped and failed
+	"""
+
+	# logging for this run only
+	with RunContext(verbose):
+		# make sure that the output file extension is suitable
+		check_output_extension(extension)
+
+		# make sure the output folder exists, and tidy up after any earlier run that was killed
+		if out_dir is None:
+			out_dir = folder
+		if not path.exists(out_dir):
+			makedirs(out_dir)
+		remove_stale_temp(out_dir)
+
+		# hash the reference once, and list the photographs to extract
+		reference_hash = file_hash(reference)
+		manifest = read_manifest(out_dir)
+		photos = [ f for f in sorted(glob(path.join(folder, "*"))) if Path(f).suffix.lower() in PHOTO_EXTENSIONS
+			and path.abspath(f) != path.abspath(reference) ]
+		vprint(f"\nBatch extraction: {len(photos)} photographs in {folder} -> {out_dir}")
+
+		# find the photographs with missing or out of date outputs
+		todo = []
+		counts = {'extracted': 0, 'skipped': 0, 'failed': 0}
+		for photo in photos:
+			output_name = Path(photo).stem + extension
+			output = path.join(out_dir, output_name)
+			key = job_hash(file_hash(photo), reference_hash, kwargs)
+
+			# skip if the output exists and was made from the same inputs
+			entry = manifest.get(output_name)
+			if incremental and entry and entry['hash'] == key and path.isfile(output):
+				vprint(f"  - {output_name} is up to date")
+				counts['skipped'] += 1
+			else:
+				todo.append((photo, output, key))
+
+		# only prepare the reference if there is something to do (it is shared by all threads)
+		if todo:
+			prepared = prepare_reference(reference, kwargs.get('working_dpi'))
+
+		def extract(job):
+			photo, output, key = job
+			try:
+				atomic_extract(prepared, photo, output, verbose=verbose, **kwargs)
+				return job, None
+			except Exception as e:
+				return job, e
+
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			for (photo, output, key), error in executor.map(extract, todo):
+
+				# report from this thread only, so that lines from the workers do not interleave
+				print(f"{photo} -> {output}")
+				if error is not None:
+					print(f"WARNING: could not extract {photo}: {error.args[-1] if error.args else error}")
+					counts['failed'] += 1
+					continue
+
+				# record the output straight away, so that an interrupted batch can be resumed
+				manifest[path.basename(output)] = {'hash': key, 'photo': path.basename(photo)}
+				write_manifest(out_dir, manifest)
+				counts['extracted'] += 1
+
+		print(f"Batch complete: {counts['extracted']} extracted, {counts['skipped']} up to date, {counts['failed']} failed")
+		return counts
@@ -0,0 +1,116 @@
+"""
+* Benchmarks for the Paper2GIS vectorisation engines
+*
+* Vectorises the same extracted mask (a GeoTIFF written by `p2g.py extract -o out.tif`)
+*  with each engine and reports the time taken, the number of features and vertices
+*  and how closely the results agree with the default (rasterio shapes) engine, both
+*  feature by feature and for the markup as a whole. Each output mode (e.g. interior,
+*  which makes polygons from the holes) is compared separately, e.g.:
+*
+*     python -m paper2gis.benchmark test/out.tif --approx 0 1 2 --modes polygons interior
+*
+* @author jonnyhuck
+"""
+
+from time import perf_counter
+from argparse import ArgumentParser
+from rasterio import open as rio_open
+from shapely import STRtree, get_num_coordinates
+from shapely.geometry import shape
+from shapely.ops import unary_union
+
+from paper2gis.paper2gis import iter_features
+
+
+def iou(a, b):
+	"""
+	* The intersection over union of two geometries
+	"""
+	union = a.union(b).area
+	return a.intersection(b).area / union if union > 0 else 1.0
+
+
+def feature_agreement(geoms, baseline):
+	"""
+	* Match each baseline feature to the feature that overlaps it the most. A match needs
+	*  an IoU of at least 0.5, so each feature can be matched at most once
+	* @return the number of baseline features that were matched and their mean IoU
+	"""
+	tree = STRtree(geoms)
+	matches = []
+	for b in baseline:
+		best = max([ iou(geoms[i], b) for i in tree.query(b, predicate='intersects') ], default=0)
+		if best >= 0.5:
+			matches.append(best)
+	return len(matches), sum(matches) / len(matches) if matches else 0
+
+
+def vectorise(opened_map, transform, engine, approx=0, repeats=5, **kwargs):
+	"""
+	* Vectorise a mask with an engine `repeats` times
+	* @return the features (as shapely geometries) and the best time (seconds)
+	"""
+	best = None
+	for _ in range(repeats):
+		start = perf_counter()
+		geoms = [ shape(f['geometry']) for f in iter_features(opened_map, transform, engine=engine,
+			approx=approx, **kwargs) ]
+		elapsed = perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return geoms, best
+
+
+def run_benchmark(mask_path, approx=(0,), repeats=5, modes=('polygons',), **kwargs):
+	"""
+	* Compare the engines on a mask, in each output mode ('polygons' for the default output,
+	*  or 'exterior', 'interior' or 'holes'). Agreement is measured feature by feature (the
+	*  number of shapes features with a matching feature, and their mean intersection over
+	*  union) and as the IoU of the area covered by each engine and the shapes engine.
+	*  Additional keyword arguments are passed to iter_features (e.g. min_area)
+	* @return a list of dicts (one per mode / engine / tolerance)
+	"""
+
+	# read the mask (markup = 255)
+	with rio_open(mask_path) as src:
+		opened_map = src.read(1)
+		transform = src.transform
+
+	results = []
+	for mode in modes:
+		options = dict(kwargs, **({} if mode == 'polygons' else {mode: True}))
+
+		# the default engine is the baseline
+		baseline, baseline_time = vectorise(opened_map, transform, 'shapes', 0, repeats, **options)
+		baseline_area = unary_union(baseline)
+		results.append({'mode': mode, 'engine': 'shapes', 'approx': 0, 'seconds': baseline_time,
+			'speedup': 1.0, 'features': len(baseline), 'vertices': int(get_num_coordinates(baseline).sum()),
+			'matched': len(baseline), 'feature_iou': 1.0, 'iou': 1.0})
+
+		# each tolerance of the contours engine
+		for tolerance in approx:
+			geoms, seconds = vectorise(opened_map, transform, 'contours', tolerance, repeats, **options)
+			matched, feature_iou = feature_agreement(geoms, baseline)
+			results.append({'mode': mode, 'engine': 'contours', 'approx': tolerance, 'seconds': seconds,
+				'speedup': baseline_time / seconds, 'features': len(geoms),
+				'vertices': int(get_num_coordinates(geoms).sum()), 'matched': matched, 'feature_iou': feature_iou,
+				'iou': iou(unary_union(geoms), baseline_area)})
+
+	# report (matched is the number of shapes features with a matching feature, and their mean IoU)
+	print(f"{'mode':<10}{'engine':<10}{'approx':>8}{'seconds':>10}{'speedup':>9}{'features':>10}{'vertices':>10}" +
+		f"{'matched':>9}{'mean IoU':>10}{'area IoU':>10}")
+	for r in results:
+		print(f"{r['mode']:<10}{r['engine']:<10}{r['approx']:>8g}{r['seconds']:>10.4f}{r['speedup']:>8.1f}x" +
+			f"{r['features']:>10}{r['vertices']:>10}{r['matched']:>9}{r['feature_iou']:>10.4f}{r['iou']:>10.4f}")
+	return results
+
+
+if __name__ == '__main__':
+	parser = ArgumentParser("Paper2GIS vectorisation benchmark")
+	parser.add_argument('mask', help='an extracted mask (GeoTIFF)')
+	parser.add_argument('-p', '--approx', type=float, nargs='+', help='simplification tolerances (pixels) to test with the contours engine', default=[0])
+	parser.add_argument('-n', '--repeats', type=int, help='the number of times to run each engine (the best time is reported)', default=5)
+	parser.add_argument('-a', '--min_area', type=float, help='the area below which features will be rejected', default=1000)
+	parser.add_argument('-s', '--simplify', type=float, help='simplification tolerance for the output of both engines (map units)', default=0)
+	parser.add_argument('-m', '--modes', nargs='+', choices=['polygons', 'exterior', 'interior', 'holes'], help='the output modes to compare', default=['polygons', 'interior'])
+	args = parser.parse_args()
+	run_benchmark(args.mask, args.approx, args.repeats, args.modes, min_area=args.min_area, simplify=args.simplify)
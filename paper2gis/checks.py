@@ -0,0 +1,232 @@
+"""
+* Reproducible checks for the Paper2GIS concurrency code, e.g.:
+*
+*     python -m paper2gis.checks tiles
+*     python -m paper2gis.checks jobqueue --workers 3
+*
+*  tiles: fetches tiles from a local stand-in tile server that injects latency and
+*   503 / 429 / 404 responses, and checks the retries and backoff, the reuse of
+*   keep-alive connections and the rate limit
+*  jobqueue: runs several worker processes on a temporary queue of photographs, one of
+*   which has been claimed by a worker that then died, and checks that every job is
+*   done once and that the job of the dead worker is re-queued when its lease expires
+*
+* @author jonnyhuck
+"""
+
+from sys import exit
+from os import path, makedirs
+from time import sleep, perf_counter
+from tempfile import TemporaryDirectory
+from multiprocessing import get_context
+from threading import Thread, Lock
+from collections import defaultdict
+from argparse import ArgumentParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from paper2gis.tiles import TileFetcher, prefetch_tiles
+from paper2gis.jobqueue import JobQueue, run_enqueue, run_worker
+
+# the test images (see p2g.py test)
+TEST_DIR = path.join(path.dirname(path.dirname(path.abspath(__file__))), 'test')
+
+# a 1x1 transparent PNG
+PNG = bytes.fromhex('89504e470d0a1a0a0000000d49484452000000010000000108060000001f15c489' +
+	'0000000d49444154789c6360000002000154a24f5d0000000049454e44ae426082')
+
+
+class StandInTileServer(ThreadingHTTPServer):
+	"""
+	* A local tile server for the tile fetching checks. Every request is delayed by `delay`
+	*  seconds, and the first request for each path in `fail` gets that status (e.g. 503 or
+	*  429) so that it succeeds when retried. Paths in `missing` always get a 404. The server
+	*  records the time of each request (by path) and the number of connections opened
+	"""
+	daemon_threads = True
+
+	def __init__(self, delay=0.01, fail=None, missing=()):
+		super().__init__(('127.0.0.1', 0), StandInTileHandler)
+		self.delay = delay
+		self.fail = dict(fail or {})
+		self.missing = set(missing)
+		self.requests = defaultdict(list)
+		self.connections = 0
+		self.lock = Lock()
+
+	@property
+	def url_template(self):
+		return f"http://127.0.0.1:{self.server_address[1]}/{{z}}/{{x}}/{{y}}.png"
+
+	def __enter__(self):
+		Thread(target=self.serve_forever, daemon=True).start()
+		return self
+
+	def __exit__(self, *args):
+		self.shutdown()
+		self.server_close()
+
+
+class StandInTileHandler(BaseHTTPRequestHandler):
+	"""
+	* Request handler for StandInTileServer (HTTP/1.1, so connections are kept alive)
+	"""
+	protocol_version = 'HTTP/1.1'
+
+	def setup(self):
+		super().setup()
+		with self.server.lock:
+			self.server.connections += 1
+
+	def do_GET(self):
+		with self.server.lock:
+			self.server.requests[self.path].append(perf_counter())
+			first = len(self.server.requests[self.path]) == 1
+		sleep(self.server.delay)
+		if self.path in self.server.missing:
+			status = 404
+		elif first and self.path in self.server.fail:
+			status = self.server.fail[self.path]
+		else:
+			status = 200
+		body = PNG if status == 200 else b''
+		self.send_response(status)
+		self.send_header('Content-Type', 'image/png')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, *args):
+		pass
+
+
+def check(results, name, passed, detail):
+	"""
+	* Record and print the result of a check
+	"""
+	print(f"{'PASS' if passed else 'FAIL'}  {name}: {detail}")
+	results.append(passed)
+
+
+def check_tiles(workers=8, rate=100, backoff=0.1, delay=0.01):
+	"""
+	* Fetch tiles from a stand-in tile server and check the retries and backoff, the reuse of
+	*  keep-alive connections and the rate limit
+	* @return True if every check passed
+	"""
+	from shapely.geometry import box
+	from paper2gis.gis2paper import PrefetchedOSM
+
+	# the tiles covering a small area (central Manchester, web mercator) at zoom 15
+	tiler = PrefetchedOSM()
+	domain = box(-252000, 7069000, -246000, 7073000)
+	tiles = list(tiler.find_images(domain, 15))
+	paths = [ f"/{z}/{x}/{y}.png" for x, y, z in tiles ]
+
+	# every 5th tile fails first time (alternately 503 and 429), and one tile is missing
+	fail = { p: (503, 429)[i % 2] for i, p in enumerate(paths[::5]) }
+	missing = paths[-1]
+	results = []
+	with StandInTileServer(delay, fail, [missing]) as server:
+		tiler.url_template = server.url_template
+		fetcher = TileFetcher(max_workers=workers, rate=rate, retries=3, backoff=backoff)
+		start = perf_counter()
+		fetched, failed = prefetch_tiles([tiler], domain, 15, fetcher)
+		elapsed = perf_counter() - start
+
+	# retries: every tile arrives apart from the missing one, which is not retried
+	check(results, "tiles", fetched == len(tiles) - 1 and failed == 1 and tiles[-1] not in tiler.tiles,
+		f"{fetched} of {len(tiles)} fetched from {server.url_template}, {failed} failed")
+	retried = [ len(server.requests[p]) for p in fail ]
+	check(results, "retry 503/429", all(n == 2 for n in retried),
+		f"{len(fail)} failed tiles requested {sorted(set(retried))} times")
+	check(results, "no retry 404", len(server.requests[missing]) == 1,
+		f"missing tile requested {len(server.requests[missing])} times")
+
+	# backoff: the retry comes at least `backoff` seconds after the failure
+	gaps = [ server.requests[p][1] - server.requests[p][0] - delay for p in fail ]
+	check(results, "backoff", min(gaps) >= backoff * 0.9, f"shortest gap before a retry {min(gaps):.3f}s")
+
+	# keep-alive: one connection per worker thread, not one per request
+	total = sum(len(r) for r in server.requests.values())
+	check(results, "keep-alive", server.connections <= workers,
+		f"{total} requests over {server.connections} connections ({workers} workers)")
+
+	# rate limit: no more than `rate` requests per second
+	times = sorted(t for r in server.requests.values() for t in r)
+	observed = (len(times) - 1) / (times[-1] - times[0])
+	check(results, "rate limit", observed <= rate * 1.1,
+		f"{observed:.1f} requests / second (limit {rate}), {elapsed:.2f}s in total")
+	return all(results)
+
+
+def check_jobqueue(workers=3, jobs=6, lease=2, scale=0.4):
+	"""
+	* Run `workers` worker processes on a temporary queue of `jobs` photographs (copies of
+	*  the test photograph, reduced by `scale` to limit the memory used by each process).
+	*  Before the workers start, the first job is claimed by a worker that never reports
+	*  back, so its lease has to expire and the job be re-queued for one of the others. The
+	*  lease is shorter than an extraction, so the workers' heartbeats must keep their jobs
+	* @return True if every check passed
+	"""
+	from cv2 import imread, imwrite, resize, INTER_AREA
+
+	results = []
+	with TemporaryDirectory() as tmp:
+
+		# the photographs
+		photo_dir, out_dir = path.join(tmp, 'photos'), path.join(tmp, 'out')
+		makedirs(photo_dir)
+		photo = imread(path.join(TEST_DIR, 'target.jpg'))
+		photo = resize(photo, None, fx=scale, fy=scale, interpolation=INTER_AREA)
+		for i in range(jobs):
+			imwrite(path.join(photo_dir, f"photo_{i}.jpg"), photo)
+
+		# the queue, and a worker that claims the first job and then dies
+		queue_path = path.join(tmp, 'queue.db')
+		run_enqueue(queue_path, path.join(TEST_DIR, 'reference.png'), [photo_dir], out_dir)
+		queue = JobQueue(queue_path)
+		dead = queue.claim('dead-worker', lease=1)
+		sleep(1.5)
+
+		# the workers, each in its own process
+		context = get_context('spawn')
+		processes = [ context.Process(target=run_worker, args=(queue_path, f"worker-{i}", lease))
+			for i in range(workers) ]
+		start = perf_counter()
+		for p in processes:
+			p.start()
+		for p in processes:
+			p.join()
+		elapsed = perf_counter() - start
+
+		# the outcome of every job
+		rows = [ dict(r) for r in queue.db.execute("SELECT * FROM jobs ORDER BY id") ]
+		queue.close()
+		outputs = [ path.isfile(path.join(out_dir, f"photo_{i}.shp")) for i in range(jobs) ]
+
+	# every job is done, by one of the workers, and the workers all exited cleanly
+	done = [ r for r in rows if r['status'] == 'done' ]
+	check(results, "jobs", len(done) == jobs and all(outputs),
+		f"{len(done)} of {jobs} done ({sum(outputs)} outputs) in {elapsed:.1f}s")
+	check(results, "workers", all(p.exitcode == 0 for p in processes),
+		f"exit codes {[ p.exitcode for p in processes ]}")
+	per_worker = { w: sum(r['worker'] == w for r in rows) for w in sorted(set(r['worker'] for r in rows)) }
+	check(results, "shared", 'dead-worker' not in per_worker and len(per_worker) > 1,
+		f"jobs per worker {per_worker}")
+
+	# the job of the dead worker was re-queued once, and every other job was only run once
+	requeued = next(r for r in rows if r['id'] == dead['id'])
+	check(results, "expired lease", requeued['attempts'] == 2 and requeued['status'] == 'done',
+		f"job {dead['id']} was claimed by dead-worker then {requeued['worker']} ({requeued['attempts']} attempts)")
+	check(results, "claimed once", all(r['attempts'] == 1 for r in rows if r['id'] != dead['id']),
+		f"attempts {[ r['attempts'] for r in rows ]}")
+	return all(results)
+
+
+if __name__ == '__main__':
+	parser = ArgumentParser("Paper2GIS checks")
+	parser.add_argument('check', choices=['tiles', 'jobqueue'], help='the check to run')
+	parser.add_argument('-w', '--workers', type=int, help='the number of worker threads (tiles) or processes (jobqueue)', default=None)
+	args = parser.parse_args()
+	kwargs = {} if args.workers is None else {'workers': args.workers}
+	exit(0 if { 'tiles': check_tiles, 'jobqueue': check_jobqueue }[args.check](**kwargs) else 1)
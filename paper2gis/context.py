@@ -0,0 +1,76 @@
+"""
+* Per-call logging and metrics for the Paper2GIS system
+*
+* The settings for a run (e.g. verbose output) are held in a ContextVar rather than
+*  a module-level global, so that extractions running concurrently in different threads
+*  each have their own logging and timings
+*
+* @author jonnyhuck
+"""
+
+from time import perf_counter
+from contextvars import ContextVar
+from contextlib import contextmanager
+
+
+# the context of the current run (None outside of a run)
+_current = ContextVar('paper2gis_run', default=None)
+
+
+class RunContext:
+	"""
+	* The logging and metrics context for a single run, used as a context manager:
+	*
+	*     with RunContext(verbose=True, label='IMG_0001.jpg') as ctx:
+	*         ...
+	*     print(ctx.metrics)
+	"""
+	def __init__(self, verbose=False, label=None):
+		self.verbose = verbose
+		self.label = label
+		self.metrics = {}
+		self._token = None
+
+	def __enter__(self):
+		self._token = _current.set(self)
+		return self
+
+	def __exit__(self, *exc):
+		_current.reset(self._token)
+		return False
+
+	def log(self, *args, **kwargs):
+		"""Print only if verbose mode is enabled (prefixed with the label, if there is one)"""
+		if self.verbose:
+			if self.label:
+				args = (f"[{self.label}]",) + args
+			print(*args, **kwargs)
+
+	@contextmanager
+	def timer(self, name):
+		"""Add the time spent in a block to the named metric (seconds)"""
+		start = perf_counter()
+		try:
+			yield
+		finally:
+			self.metrics[name] = self.metrics.get(name, 0) + perf_counter() - start
+
+
+def current():
+	"""
+	* Get the context of the current run (a quiet one if there is not a run)
+	"""
+	ctx = _current.get()
+	return ctx if ctx is not None else RunContext()
+
+
+def vprint(*args, **kwargs):
+	"""Print only if verbose mode is enabled"""
+	ctx = _current.get()
+	if ctx is not None:
+		ctx.log(*args, **kwargs)
+
+
+def timer(name):
+	"""Time a block of code, adding it to the metrics of the current run"""
+	return current().timer(name)
@@ -5,10 +5,12 @@
 * @author jonnyhuck
 """
 
+from os import path
 from sys import exit
 from math import ceil
 from uuid import uuid4
 from io import BytesIO
+from collections import OrderedDict
 from qrcode import QRCode
 from numpy.random import rand
 from datetime import datetime
@@ -16,28 +18,25 @@ from PIL.ImageOps import expand
 from fiona.errors import DriverError
 from PIL import Image, ImageDraw, ImageFont
 from qrcode.constants import ERROR_CORRECT_L
-from cartopy.io.img_tiles import GoogleTiles
+from cartopy.io.img_tiles import GoogleTiles, OSM
+from paper2gis.tiles import PrefetchedTiles, TileFetcher, prefetch_tiles
+from paper2gis.context import RunContext, vprint
 
 
-# Module-level verbose flag
-_VERBOSE = False
-
-def vprint(*args, **kwargs):
-	"""Print only if verbose mode is enabled"""
-	if _VERBOSE:
-		print(*args, **kwargs)
-
-class ShadedReliefESRI(GoogleTiles):
+class ShadedReliefESRI(PrefetchedTiles, GoogleTiles):
     """
     * Custom class for hillshade tiles from ESRI, see: 
 	*	https://stackoverflow.com/questions/37423997/cartopy-shaded-relief
 	"""
-    def _image_url(self, tile):
-        x, y, z = tile
-        url = ('https://server.arcgisonline.com/ArcGIS/rest/services/' \
-               'World_Shaded_Relief/MapServer/tile/{z}/{y}/{x}.jpg').format(
-               z=z, y=y, x=x)
-        return url
+    url_template = ('https://server.arcgisonline.com/ArcGIS/rest/services/' \
+        'World_Shaded_Relief/MapServer/tile/{z}/{y}/{x}.jpg')
+
+
+class PrefetchedOSM(PrefetchedTiles, OSM):
+	"""
+	* OSM tiles, served from the concurrent prefetch where possible
+	"""
+	pass
 
 
 def figure_to_image(fig, dpi=None):
@@ -51,8 +50,116 @@ def figure_to_image(fig, dpi=None):
 	return img.convert("RGBA")
 
 
+class BoundaryCache:
+	"""
+	* The boundaries read for earlier maps, so that a script that makes several maps of the
+	*  same area (e.g. a copy for each participant) only reads the Shapefile once: pass the
+	*  same BoundaryCache to each call of run_generate (or get_osm_map). Only the `maxsize`
+	*  most recently used reads are kept
+	"""
+	def __init__(self, maxsize=8):
+		self.maxsize = maxsize
+		self._reads = OrderedDict()
+
+	def _file(self, boundary_file):
+		"""identify a file (including its modification time, so that edits are not missed)"""
+		return path.abspath(boundary_file), path.getmtime(boundary_file)
+
+	def get(self, boundary_file, extent):
+		"""
+		* Get the geometries from an earlier read that covers an extent (bl_x, bl_y, tr_x, tr_y)
+		* @return a list of shapely geometries, or None if there is no such read
+		"""
+		file = self._file(boundary_file)
+		for key, geoms in self._reads.items():
+			read_file, read_extent = key
+			if read_file == file and read_extent[0] <= extent[0] and read_extent[1] <= extent[1] \
+					and read_extent[2] >= extent[2] and read_extent[3] >= extent[3]:
+				self._reads.move_to_end(key)
+				return geoms
+		return None
+
+	def put(self, boundary_file, extent, geoms):
+		"""
+		* Keep the geometries read for an extent
+		"""
+		self._reads[(self._file(boundary_file), tuple(extent))] = geoms
+		while len(self._reads) > self.maxsize:
+			self._reads.popitem(last=False)
+
+
+def read_boundaries(boundary_file, bounds, cache=None):
+	"""
+	* Read the boundaries that could appear on a map, using the Shapefile's spatial index
+	*  (if it has one) to read only the features whose bounding box is within the map (plus
+	*  the margin that they are clipped to)
+	* 
+	* Parameters:
+	*     boundary_file: path to the Shapefile (in the crs of the map)
+	*     bounds: the map extent (bl_x, bl_y, tr_x, tr_y)
+	*     cache: a BoundaryCache to re-use the features read for an earlier map (optional)
+	* 
+	* @return a list of shapely geometries
+	"""
+	from fiona import open as fio_open
+	from shapely.geometry import box, shape
+
+	# re-use an earlier read if it covers this map
+	extent = boundary_extent(bounds)
+	if cache is not None:
+		geoms = cache.get(boundary_file, extent)
+		if geoms is not None:
+			vprint(f"  - Re-used {len(geoms)} boundary features read for an earlier map")
+			return geoms
+
+	# read the features within the extent, clipped to it
+	clip = box(*extent)
+	geoms = []
+	with fio_open(boundary_file) as src:
+		total = len(src)
+		for feature in src.filter(bbox=extent):
+			geom = shape(feature['geometry'])
+			if not geom.is_valid:
+				geom = geom.buffer(0)
+			geom = geom.intersection(clip)
+			if not geom.is_empty:
+				geoms.append(geom)
+	vprint(f"  - Read {len(geoms)} of {total} boundary features")
+	if cache is not None:
+		cache.put(boundary_file, extent, geoms)
+	return geoms
+
+
+def boundary_extent(bounds):
+	"""
+	* The area that boundaries are clipped to: a little more than the map, so that the
+	*  cut edges are off the map
+	"""
+	margin = max(bounds[2] - bounds[0], bounds[3] - bounds[1]) * 0.05
+	return bounds[0] - margin, bounds[1] - margin, bounds[2] + margin, bounds[3] + margin
+
+
+def prepare_boundaries(geoms, bounds, tolerance):
+	"""
+	* Clip boundaries to a map and simplify them to the size of an output pixel (tolerance,
+	*  in map units), so that only what can be seen on the map is drawn
+	* @return a list of shapely geometries
+	"""
+	from shapely.geometry import box
+
+	extent = box(*boundary_extent(bounds))
+	prepared = []
+	for geom in geoms:
+		if geom.intersects(extent):
+			geom = geom.intersection(extent).simplify(tolerance, preserve_topology=True)
+			if not geom.is_empty:
+				prepared.append(geom)
+	return prepared
+
+
 def get_osm_map(bl_x, bl_y, tr_x, tr_y, zoom, w, h, dpi=96, crs=None, fade=85, hillshade=False, hillshade_alpha=0.25, 
-				boundary_file=None, boundary_width=8, boundary_colour='blue', boundary_alpha=0.1):
+				boundary_file=None, boundary_width=8, boundary_colour='blue', boundary_alpha=0.1, tile_workers=8,
+				tile_url=None, hillshade_url=None, boundary_cache=None):
 	"""
 	* Return an OSM map as a PIL image
 	* 
@@ -63,11 +170,15 @@ def get_osm_map(bl_x, bl_y, tr_x, tr_y, zoom, w, h, dpi=96, crs=None, fade=85, h
 	*     dpi: resolution of the output image (default 96)
 	*     crs: the crs of the input coordinates (default Web Mercator)
 	*     fade: (0-255) the intensity of the white filter
+	*     tile_workers: the number of tiles to download concurrently
+	*     tile_url, hillshade_url: URL templates for the map and hillshade tiles, e.g.
+	*      'http://localhost:8000/{z}/{x}/{y}.png' (default: OSM and ESRI)
+	*     boundary_cache: a BoundaryCache to re-use boundaries read for earlier maps (optional)
 	"""
 	# load additional libraries
 	from PIL.Image import BILINEAR
+	from shapely.geometry import box
 	from matplotlib import pyplot as plt
-	from cartopy.io.img_tiles import OSM
 
 	vprint(f"Downloading OSM tiles (zoom={zoom}, dimensions={w}x{h})...")
 
@@ -77,7 +188,7 @@ def get_osm_map(bl_x, bl_y, tr_x, tr_y, zoom, w, h, dpi=96, crs=None, fade=85, h
 			map unless you are drawing a map of the wole world.\n")
 
 	# get OSM tile interface
-	tiler = OSM()
+	tiler = PrefetchedOSM(url_template=tile_url)
 
 	# if no CRS is specified, assume Web Mercator
 	if crs is None:
@@ -112,6 +223,12 @@ def get_osm_map(bl_x, bl_y, tr_x, tr_y, zoom, w, h, dpi=96, crs=None, fade=85, h
 	# set the desired map extent on the axis
 	ax.set_extent([bl_x, tr_x, bl_y, tr_y], crs=tiler.crs)
 
+	# download the tiles for all of the layers at once
+	tilers = [tiler, ShadedReliefESRI(url_template=hillshade_url)] if hillshade else [tiler]
+	fetcher = TileFetcher(max_workers=tile_workers, user_agent=tiler.user_agent)
+	fetched, failed = prefetch_tiles(tilers, box(bl_x, bl_y, tr_x, tr_y), zoom, fetcher)
+	vprint(f"Downloaded {fetched} tiles ({failed} failed, these will be retried by cartopy)")
+
 	# add the map tiles to the axis and get extent
 	# TODO: Can I set zoom level automatically...?
 	ax.add_image(tiler, zoom)
@@ -119,23 +236,22 @@ def get_osm_map(bl_x, bl_y, tr_x, tr_y, zoom, w, h, dpi=96, crs=None, fade=85, h
 	# add hillshade if needed
 	if hillshade:
 		vprint(f"Adding hillshade layer (alpha={hillshade_alpha})")
-		shade = ShadedReliefESRI()
-		ax.add_image(shade, zoom, alpha=hillshade_alpha)
+		ax.add_image(tilers[1], zoom, alpha=hillshade_alpha)
 	
 	# add LD boundary
 	if boundary_file:
 		vprint(f"Adding boundary layer: {boundary_file}")
-		import cartopy.io.shapereader as shpreader
 		
-		# open the boundary file
+		# read the boundaries within the map, simplified to the size of an output pixel
 		try:
-			reader = shpreader.Reader(boundary_file)
+			bounds = (bl_x, bl_y, tr_x, tr_y)
+			geoms = prepare_boundaries(read_boundaries(boundary_file, bounds, boundary_cache), bounds, (tr_x - bl_x) / w)
 
 			# add to the map
-			ax.add_geometries(reader.geometries(), crs=tiler.crs, facecolor='none', edgecolor=boundary_colour, 
+			ax.add_geometries(geoms, crs=tiler.crs, facecolor='none', edgecolor=boundary_colour, 
 					 linewidth=boundary_width, alpha=boundary_alpha)
 			
-		except DriverError:
+		except (DriverError, FileNotFoundError):
 			if boundary_file[-4:] != ".shp":
 				print(f"ERROR: Could not open Shapefile {boundary_file}, please check file extension")
 			else:
@@ -165,12 +281,24 @@ def mm2px(mm, dpi=96):
 	return int(ceil(mm * dpi / 25.4))
 
 
+def px_at_dpi(px, dpi):
+	"""
+	* Scale a size in pixels at 96dpi (which the layout was designed at) to another resolution
+	"""
+	return max(1, int(round(px * dpi / 96)))
+
+
 def run_generate(blX, blY, trX, trY, epsg, dpi, in_path, out_path, tiles, fade, zoom, hillshade, 
-				 hillshade_alpha, boundary_file, boundary_width, boundary_colour, boundary_alpha, verbose=False):
+				 hillshade_alpha, boundary_file, boundary_width, boundary_colour, boundary_alpha, verbose=False, tile_workers=8,
+				 tile_url=None, hillshade_url=None, boundary_cache=None):
 	"""
 	* Generate a Paper2GIS layout from an existing map, or generate one from tiles
 	* 
-	* TODO: implement resolution options?
+	* The tiles can be drawn from another tile server by passing URL templates for the map
+	*  and hillshade tiles (tile_url, hillshade_url), e.g. 'http://localhost:8000/{z}/{x}/{y}.png'.
+	*  To make several layouts of the same area (e.g. a copy for each participant) without
+	*  reading the boundary file each time, pass the same BoundaryCache to each call
+	* 
 	* TODO: add args for page settings (presets and orientations?), tile zoom level and fade
 	* ---
 	* Info on QR Args:
@@ -190,147 +318,152 @@ def run_generate(blX, blY, trX, trY, epsg, dpi, in_path, out_path, tiles, fade,
 	* 	- The border parameter controls how many boxes thick the border should be (the default is 4, which is the minimum according to the specs).
 	"""
 
-	# Set module-level verbose flag
-	global _VERBOSE
-	_VERBOSE = verbose
-
-	source = f"OSM tiles (zoom={zoom})" if tiles else in_path
-	vprint(f"\nGenerating Paper2GIS layout: {source} -> {out_path}")
-	vprint(f"Parameters: EPSG:{epsg}, bounds=[{blX}, {blY}, {trX}, {trY}]")
-
-	# init qrcode object
-	qr = QRCode(
-		version=1,
-		error_correction=ERROR_CORRECT_L,
-		box_size=10,
-		border=4,
-	)
-
-	# get unique number hex (truncate to 8 characters)
-	uid = uuid4().hex[:8]
-	vprint(f"Generated UUID: {uid}")
-
-	# page dimensions in mm
-	w_mm = 297
-	h_mm = 420
-
-	# the gap between the map and the qr code etc
-	map_buffer = mm2px(6)
-
-	#  page dimensions in px
-	page_w = mm2px(w_mm)
-	page_h = mm2px(h_mm)
-
-	# buffer around page in mm
-	page_buffer = mm2px(3, dpi)
-
-	# qr code size
-	qr_size = mm2px(30, dpi)
-
-	# the height of the map
-	map_height = 1436
-
-	# MAP DIMENSIONS 1084 x 1436 @ 96dpi
-	# this is from JS to scale between resolutions
-	# width =   parseInt(3508 / 300 * 96 - mm2px(10, 96));
-	# height =  parseInt(4961 / 300 * 96 - mm2px(40, 96));
-
-	# scaling for the noise border
-	divider = 10
-
-	'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
-	'''''''''''''''''''''''''''''''''''''' DRAWING ''''''''''''''''''''''''''''''''''''''''''
-	'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
-
-	# make new blank, page sized image
-	page = Image.new('RGB', (page_w, page_h), 'white')
-
-	# get input image or create one from tiles
-	if tiles:
-		# note we might need to overwrite the dimensions here as the map gets adjusted to fit the template
-		c, in_map = get_osm_map(float(blX), float(blY), float(trX), float(trY), zoom, 1084, 1436, fade=fade, hillshade=hillshade, 
-						  hillshade_alpha=hillshade_alpha, boundary_file=boundary_file, boundary_width=boundary_width, 
-						  boundary_colour=boundary_colour, boundary_alpha=boundary_alpha) 
-		blX = str(c[0])
-		blY = str(c[1])
-		trX = str(c[2])
-		trY = str(c[3])
-	else:
-		vprint(f"Loading map image: {in_path}")
+	# logging for this run only
+	with RunContext(verbose):
+		source = f"OSM tiles (zoom={zoom})" if tiles else in_path
+		vprint(f"\nGenerating Paper2GIS layout: {source} -> {out_path}")
+		vprint(f"Parameters: EPSG:{epsg}, bounds=[{blX}, {blY}, {trX}, {trY}], dpi={dpi}")
+
+		# init qrcode object
+		qr = QRCode(
+			version=1,
+			error_correction=ERROR_CORRECT_L,
+			box_size=10,
+			border=4,
+		)
+
+		# get unique number hex (truncate to 8 characters)
+		uid = uuid4().hex[:8]
+		vprint(f"Generated UUID: {uid}")
+
+		# page dimensions in mm
+		w_mm = 297
+		h_mm = 420
+
+		# the gap between the map and the qr code etc
+		map_buffer = mm2px(6, dpi)
+
+		#  page dimensions in px
+		page_w = mm2px(w_mm, dpi)
+		page_h = mm2px(h_mm, dpi)
+
+		# buffer around page in mm
+		page_buffer = mm2px(3, dpi)
+
+		# qr code size
+		qr_size = mm2px(30, dpi)
+
+		# MAP DIMENSIONS 1084 x 1436 @ 96dpi, scaled to the requested resolution
+		# this is from JS to scale between resolutions
+		# width =   parseInt(3508 / 300 * 96 - mm2px(10, 96));
+		# height =  parseInt(4961 / 300 * 96 - mm2px(40, 96));
+		map_width = px_at_dpi(1084, dpi)
+		map_height = px_at_dpi(1436, dpi)
+
+		# the black and white borders around the map (the extractor crops inside them)
+		black_border = px_at_dpi(4, dpi)
+		white_border = px_at_dpi(2, dpi)
+		map_border = black_border + white_border
+
+		# scaling for the noise border
+		divider = px_at_dpi(10, dpi)
+		vprint(f"Layout resolution: {dpi} dpi ({page_w}x{page_h} pixels)")
+
+		'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+		'''''''''''''''''''''''''''''''''''''' DRAWING ''''''''''''''''''''''''''''''''''''''''''
+		'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+		# make new blank, page sized image
+		page = Image.new('RGB', (page_w, page_h), 'white')
+
+		# get input image or create one from tiles
+		if tiles:
+			# note we might need to overwrite the dimensions here as the map gets adjusted to fit the template
+			c, in_map = get_osm_map(float(blX), float(blY), float(trX), float(trY), zoom, map_width, map_height, dpi=dpi, fade=fade, hillshade=hillshade, 
+							  hillshade_alpha=hillshade_alpha, boundary_file=boundary_file, boundary_width=boundary_width, 
+							  boundary_colour=boundary_colour, boundary_alpha=boundary_alpha, tile_workers=tile_workers,
+							  tile_url=tile_url, hillshade_url=hillshade_url, boundary_cache=boundary_cache) 
+			blX = str(c[0])
+			blY = str(c[1])
+			trX = str(c[2])
+			trY = str(c[3])
+		else:
+			vprint(f"Loading map image: {in_path}")
+			try:
+				in_map = Image.open(in_path)
+				vprint(f"Loaded: {in_map.size[0]}x{in_map.size[1]} pixels")
+			except FileNotFoundError:
+				print("ERROR: cannot open input map file, please check file path")
+				exit()
+
+		# open the map and add black border
+		map = expand(expand(in_map, border=black_border, fill='black'), border=white_border, fill='white')
+
+		# generate random noise for border
+		vprint("Compositing layout with border and map...")
+		noise = rand((map_height + page_buffer*2 + map_border*2)//divider, page_w//divider, 3) * 255
+
+		# turn random noise into greyscale image
+		noise_im = Image.fromarray(noise.astype('uint8')).resize((noise.shape[1]*divider, noise.shape[0]*divider), Image.NEAREST).convert('L')
+		page.paste(noise_im, (0, 0))
+
+		# add the map to the image
+		page.paste(map, (page_buffer, page_buffer))
+
+		vprint("Generating QR code with georeferencing metadata...")
+	
+		# add data to qr object, 'make' and export to image (the resolution goes before the uid, which is always last)
+		qr.add_data(','.join([blX, blY, trX, trY, epsg, str(page_buffer+map_border), str(page_buffer+map_border), 
+			str(page_buffer+map.size[0]-map_border), str(page_buffer+map.size[1]-map_border), str(dpi), uid]))
+		qr.make(fit=True)
+		qrcode_im = qr.make_image()
+
+		# add qr code to the map
+		page.paste(qrcode_im.resize((qr_size, qr_size)), (page_w - page_buffer - qr_size, map_height + map_buffer + page_buffer))
+
+		# open the north arrow and add to the page
 		try:
-			in_map = Image.open(in_path)
-			vprint(f"Loaded: {in_map.size[0]}x{in_map.size[1]} pixels")
+			north = Image.open('./resources/north.png').resize((qr_size - page_buffer, qr_size - page_buffer))
 		except FileNotFoundError:
-			print("ERROR: cannot open input map file, please check file path")
+			print("ERROR: Cannot find North Arrow file - please check installation")
 			exit()
+		page.paste(north, (page_w - page_buffer - (qr_size*2), map_height + map_buffer + page_buffer // 2 + page_buffer), north)
 
-	# open the map and add black border
-	map = expand(expand(in_map, border=4, fill='black'), border=2, fill='white')
+		# get drawing context for page
+		draw = ImageDraw.Draw(page)
 
-	# generate random noise for border
-	vprint("Compositing layout with border and map...")
-	noise = rand((map_height + page_buffer*2 + 6*2)//divider, page_w//divider, 3) * 255
+		# prepare a font
+		try:
+			font = ImageFont.truetype('./resources/OpenSans-Regular.ttf', px_at_dpi(12, dpi))
+		except OSError:
+			print("ERROR: Cannot find Open Sans font file - please check installation")
+			exit()
 
-	# turn random noise into greyscale image
-	noise_im = Image.fromarray(noise.astype('uint8')).resize((noise.shape[1]*divider, noise.shape[0]*divider), Image.NEAREST).convert('L')
-	page.paste(noise_im, (0, 0))
+		# get the dimensions of the text and page
+		bbox = draw.textbbox((0, 0), uid, font=font, anchor="la")
+		th = bbox[3] - bbox[1]
 
-	# add the map to the image
-	page.paste(map, (page_buffer, page_buffer))
+		# add attribution text
+		year = str(datetime.today().year)
+		attribution_text_list = ["Paper2GIS Copyright", year, "Dr Jonny Huck: https://github.com/jonnyhuck/paper2gis."]
+		if tiles:
+			attribution_text_list += ["\nMap data Copyright", year, "OpenStreetMap Contributors."]
+			if hillshade:
+				attribution_text_list += ["Hillshade data Copyright", year, "ESRI, USGS."]
+		attribution_text = " ".join(attribution_text_list)
+		draw.text((page_buffer, page_h - mm2px(3, dpi) - th*2), attribution_text, fill='black', font=font)
 
-	vprint("Generating QR code with georeferencing metadata...")
-	
-	# add data to qr object, 'make' and export to image
-	qr.add_data(','.join([blX, blY, trX, trY, epsg, str(page_buffer+6), str(page_buffer+6), str(page_buffer+map.size[0]-6), str(page_buffer+map.size[1]-6), uid]))
-	qr.make(fit=True)
-	qrcode_im = qr.make_image()
-
-	# add qr code to the map
-	page.paste(qrcode_im.resize((qr_size, qr_size)), (page_w - page_buffer - qr_size, map_height + map_buffer + page_buffer))
-
-	# open the north arrow and add to the page
-	try:
-		north = Image.open('./resources/north.png').resize((qr_size - page_buffer, qr_size - page_buffer))
-	except FileNotFoundError:
-		print("ERROR: Cannot find North Arrow file - please check installation")
-		exit()
-	page.paste(north, (page_w - page_buffer - (qr_size*2), map_height + map_buffer + page_buffer // 2 + page_buffer), north)
-
-	# get drawing context for page
-	draw = ImageDraw.Draw(page)
-
-	# prepare a font
-	try:
-		font = ImageFont.truetype('./resources/OpenSans-Regular.ttf', 12)
-	except OSError:
-		print("ERROR: Cannot find Open Sans font file - please check installation")
-		exit()
-
-	# get the dimensions of the text and page
-	bbox = draw.textbbox((0, 0), uid, font=font, anchor="la")
-	th = bbox[3] - bbox[1]
-
-	# add attribution text
-	year = str(datetime.today().year)
-	attribution_text_list = ["Paper2GIS Copyright", year, "Dr Jonny Huck: https://github.com/jonnyhuck/paper2gis."]
-	if tiles:
-		attribution_text_list += ["\nMap data Copyright", year, "OpenStreetMap Contributors."]
-		if hillshade:
-			attribution_text_list += ["Hillshade data Copyright", year, "ESRI, USGS."]
-	attribution_text = " ".join(attribution_text_list)
-	draw.text((page_buffer, page_h - mm2px(3) - th*2), attribution_text, fill='black', font=font)
-
-	# add uuid text
-	draw.text((page_buffer, page_h - mm2px(5) - th*3), uid, fill='black', font=font)
-
-	# validate out_path is a png
-	if out_path[-4:] != ".png":
-		out_path += ".png"
-
-	# save the result
-	try:
-		page.save(out_path, 'PNG')
-		vprint(f"Saved layout to {out_path}")
-	except FileNotFoundError:
-		print("ERROR: Cannot create output file - please check file path")
-		exit()
\ No newline at end of file
+		# add uuid text
+		draw.text((page_buffer, page_h - mm2px(5, dpi) - th*3), uid, fill='black', font=font)
+
+		# validate out_path is a png
+		if out_path[-4:] != ".png":
+			out_path += ".png"
+
+		# save the result
+		try:
+			page.save(out_path, 'PNG', dpi=(dpi, dpi))
+			vprint(f"Saved layout to {out_path}")
+		except FileNotFoundError:
+			print("ERROR: Cannot create output file - please check file path")
+			exit()
\ No newline at end of file
@@ -0,0 +1,303 @@
+"""
+* A lightweight job queue for spreading extraction across several machines
+*
+* The queue is a SQLite file on a shared (network) drive. `enqueue` adds photograph /
+*  reference pairs, and any number of workers (on any machine that can see the drive)
+*  claim jobs with a lease, renew the lease with a heartbeat while they work, and report
+*  the result. If a worker dies, its lease expires and the job is re-queued for another
+*  worker. Paths are stored relative to the queue file where possible, so that machines
+*  can mount the shared drive in different places.
+*
+* NB: leases use the system clock, so the clocks of the machines should be roughly in
+*  sync (e.g. NTP). The default (rollback journal) mode is used as SQLite WAL mode does
+*  not work on network file systems.
+*
+* @author jonnyhuck
+"""
+
+import sqlite3
+from json import dumps, loads
+from socket import gethostname
+from time import time, sleep
+from threading import Event, Thread
+from os import path, getpid, makedirs
+
+from paper2gis.context import RunContext, vprint
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+	id INTEGER PRIMARY KEY AUTOINCREMENT,
+	reference TEXT NOT NULL,
+	target TEXT NOT NULL,
+	output TEXT NOT NULL,
+	params TEXT NOT NULL,
+	status TEXT NOT NULL DEFAULT 'queued',
+	worker TEXT,
+	lease_expires REAL,
+	attempts INTEGER NOT NULL DEFAULT 0,
+	error TEXT,
+	seconds REAL,
+	created REAL NOT NULL,
+	started REAL,
+	finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+"""
+
+
+class JobQueue:
+	"""
+	* A queue of extraction jobs in a SQLite file
+	*
+	* Parameters:
+	*     db_path: path to the queue file (created if it does not exist)
+	*     max_attempts: a job whose lease has expired this many times is marked as failed
+	*     timeout: how long (seconds) to wait for another process to unlock the file
+	"""
+	def __init__(self, db_path, max_attempts=3, timeout=60):
+		self.db_path = db_path
+		self.root = path.dirname(path.abspath(db_path))
+		self.max_attempts = max_attempts
+
+		# autocommit mode, so that transactions are started explicitly (BEGIN IMMEDIATE)
+		self.db = sqlite3.connect(db_path, timeout=timeout, isolation_level=None)
+		self.db.row_factory = sqlite3.Row
+		self.db.executescript(SCHEMA)
+
+	def close(self):
+		self.db.close()
+
+	def _store_path(self, p):
+		"""store paths relative to the queue file if they are on the same drive"""
+		p = path.abspath(p)
+		try:
+			rel = path.relpath(p, self.root)
+		except ValueError:
+			return p
+		return p if rel.startswith("..") else rel
+
+	def resolve(self, p):
+		"""get the local path from a stored path"""
+		return path.normpath(path.join(self.root, p))
+
+	def enqueue(self, reference, target, output, params):
+		"""
+		* Add a job to the queue
+		* @return the id of the new job
+		"""
+		cur = self.db.execute("INSERT INTO jobs (reference, target, output, params, created) VALUES (?, ?, ?, ?, ?)",
+			(self._store_path(reference), self._store_path(target), self._store_path(output),
+			dumps(params, sort_keys=True), time()))
+		return cur.lastrowid
+
+	def _requeue_expired(self, now):
+		"""re-queue the jobs of workers whose leases have expired (or fail them if tried too often)"""
+		self.db.execute("""UPDATE jobs SET status = 'failed', worker = NULL, error = 'lease expired', finished = ?
+			WHERE status = 'running' AND lease_expires < ? AND attempts >= ?""", (now, now, self.max_attempts))
+		self.db.execute("""UPDATE jobs SET status = 'queued', worker = NULL, lease_expires = NULL
+			WHERE status = 'running' AND lease_expires < ?""", (now,))
+
+	def claim(self, worker, lease=60):
+		"""
+		* Claim the next job for a worker, with a lease of `lease` seconds
+		* @return the job (a dict) or None if there are no jobs waiting
+		"""
+		now = time()
+		self.db.execute("BEGIN IMMEDIATE")
+		try:
+			self._requeue_expired(now)
+			row = self.db.execute("SELECT * FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1").fetchone()
+			if row is not None:
+				self.db.execute("""UPDATE jobs SET status = 'running', worker = ?, lease_expires = ?,
+					attempts = attempts + 1, started = ? WHERE id = ?""", (worker, now + lease, now, row['id']))
+			self.db.execute("COMMIT")
+		except BaseException:
+			self.db.execute("ROLLBACK")
+			raise
+		if row is None:
+			return None
+		job = dict(row)
+		job['params'] = loads(job['params'])
+		return job
+
+	def heartbeat(self, job_id, worker, lease=60):
+		"""
+		* Renew the lease on a job
+		* @return False if the job is no longer held by this worker (e.g. its lease expired)
+		"""
+		cur = self.db.execute("""UPDATE jobs SET lease_expires = ?
+			WHERE id = ? AND worker = ? AND status = 'running'""", (time() + lease, job_id, worker))
+		return cur.rowcount == 1
+
+	def complete(self, job_id, worker, seconds):
+		"""
+		* Mark a job as done
+		"""
+		self.db.execute("""UPDATE jobs SET status = 'done', lease_expires = NULL, seconds = ?, finished = ?
+			WHERE id = ? AND worker = ?""", (seconds, time(), job_id, worker))
+
+	def fail(self, job_id, worker, error):
+		"""
+		* Mark a job as failed (e.g. not enough matches - retrying will not help)
+		"""
+		self.db.execute("""UPDATE jobs SET status = 'failed', lease_expires = NULL, error = ?, finished = ?
+			WHERE id = ? AND worker = ?""", (str(error), time(), job_id, worker))
+
+	def progress(self):
+		"""
+		* Get the overall progress of the queue
+		* @return a dict of the number of jobs with each status, the total, the throughput
+		*  (completed jobs per minute since the first job was started) and the mean time per job
+		"""
+		counts = {'queued': 0, 'running': 0, 'done': 0, 'failed': 0}
+		for status, n in self.db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"):
+			counts[status] = n
+		counts['total'] = sum(counts.values())
+		first, last, mean = self.db.execute("""SELECT MIN(started), MAX(finished), AVG(seconds)
+			FROM jobs WHERE status = 'done'""").fetchone()
+		counts['per_minute'] = counts['done'] / (last - first) * 60 if first is not None and last > first else 0
+		counts['mean_seconds'] = mean or 0
+		return counts
+
+
+def format_progress(p):
+	"""
+	* Describe the progress of a queue in one line
+	"""
+	finished = p['done'] + p['failed']
+	return (f"{finished}/{p['total']} finished ({p['done']} done, {p['failed']} failed), {p['running']} running, " +
+		f"{p['queued']} queued - {p['per_minute']:.1f} jobs/minute, {p['mean_seconds']:.1f}s per job")
+
+
+def run_enqueue(queue_path, reference, targets, out_dir=None, extension=".shp", **kwargs):
+	"""
+	* Add extraction jobs to a queue, one per photograph (a list of files and/or folders).
+	*  Outputs are named after the photographs (e.g. IMG_0001.jpg -> IMG_0001.shp) and
+	*  written to out_dir (default: alongside the photograph). Additional keyword arguments
+	*  are passed to run_extract by the worker
+	* @author jonnyhuck
+	* @return the number of jobs added
+	"""
+	from glob import glob
+	from pathlib import Path
+	from paper2gis.batch import PHOTO_EXTENSIONS
+	from paper2gis.paper2gis import check_output_extension
+
+	# make sure that the output file extension is suitable
+	check_output_extension(extension)
+	if not path.isfile(reference):
+		raise FileNotFoundError(f"{reference} does not exist")
+
+	# expand folders into the photographs that they contain
+	photos = []
+	for target in targets:
+		if path.isdir(target):
+			photos += [ f for f in sorted(glob(path.join(target, "*"))) if Path(f).suffix.lower() in PHOTO_EXTENSIONS
+				and path.abspath(f) != path.abspath(reference) ]
+		elif path.isfile(target):
+			photos.append(target)
+		else:
+			raise FileNotFoundError(f"{target} does not exist")
+
+	if out_dir is not None and not path.exists(out_dir):
+		makedirs(out_dir)
+
+	queue = JobQueue(queue_path)
+	try:
+		for photo in photos:
+			output = path.join(out_dir if out_dir is not None else path.dirname(photo), Path(photo).stem + extension)
+			queue.enqueue(reference, photo, output, kwargs)
+		print(f"Added {len(photos)} jobs to {queue_path}")
+		print(format_progress(queue.progress()))
+	finally:
+		queue.close()
+	return len(photos)
+
+
+def run_status(queue_path):
+	"""
+	* Report the progress of a queue
+	"""
+	queue = JobQueue(queue_path)
+	try:
+		p = queue.progress()
+		print(format_progress(p))
+		for row in queue.db.execute("SELECT id, target, error FROM jobs WHERE status = 'failed' ORDER BY id"):
+			print(f"  - job {row['id']} failed ({row['target']}): {row['error']}")
+		return p
+	finally:
+		queue.close()
+
+
+def run_worker(queue_path, name=None, lease=60, poll=10, wait=False, verbose=False):
+	"""
+	* Claim and run extraction jobs from a queue until it is empty (or forever if `wait`
+	*  is True, polling every `poll` seconds for new jobs). The lease on each job is renewed
+	*  by a heartbeat thread every third of the lease, so a job is only re-queued if the
+	*  worker stops (e.g. the machine is switched off)
+	* @author jonnyhuck
+	* @return the number of jobs that this worker completed
+	"""
+	from paper2gis.batch import atomic_extract
+	from paper2gis.paper2gis import prepare_reference
+
+	# name the worker after the machine and process, so that several can run on each machine
+	if name is None:
+		name = f"{gethostname()}:{getpid()}"
+
+	# logging for this run only
+	with RunContext(verbose, name):
+		queue = JobQueue(queue_path)
+		references = {}
+		completed = 0
+		try:
+			while True:
+				job = queue.claim(name, lease)
+				if job is None:
+					if not wait:
+						break
+					sleep(poll)
+					continue
+
+				# keep the lease alive from another thread (with its own connection)
+				stop = Event()
+				def heartbeat(job_id=job['id']):
+					beat_queue = JobQueue(queue_path)
+					try:
+						while not stop.wait(lease / 3):
+							if not beat_queue.heartbeat(job_id, name, lease):
+								print(f"[{name}] WARNING: lost the lease on job {job_id}")
+								break
+					finally:
+						beat_queue.close()
+				beat = Thread(target=heartbeat, daemon=True)
+				beat.start()
+
+				# run the extraction, preparing each reference (at each resolution) only once per worker
+				target, output = queue.resolve(job['target']), queue.resolve(job['output'])
+				print(f"[{name}] job {job['id']}: {target} -> {output}")
+				start = time()
+				try:
+					params = dict(job['params'])
+					key = (queue.resolve(job['reference']), params.pop('working_dpi', None))
+					if key not in references:
+						references[key] = prepare_reference(*key)
+					atomic_extract(references[key], target, output, verbose=verbose, **params)
+					queue.complete(job['id'], name, time() - start)
+					completed += 1
+				except Exception as e:
+					error = e.args[-1] if e.args else e
+					print(f"[{name}] WARNING: job {job['id']} failed: {error}")
+					queue.fail(job['id'], name, error)
+				finally:
+					stop.set()
+					beat.join()
+
+				# report overall progress
+				vprint(format_progress(queue.progress()))
+		finally:
+			queue.close()
+
+		print(f"[{name}] finished: completed {completed} jobs")
+		return completed
@@ -23,35 +23,207 @@
 """
 
 import pillow_heif
-from sys import exit
 from glob import glob
 from PIL import Image
+from io import BytesIO
 from pathlib import Path
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from fiona import open as fio_open
 from rasterio.features import shapes
 from os import remove, path, makedirs
 from rasterio import open as rio_open
-from rasterio.transform import from_bounds
 from pyzbar.pyzbar import decode, ZBarSymbol
-from numpy import float32, uint8, ones, zeros, array
+from rasterio.transform import Affine, from_bounds, array_bounds
+from shapely import STRtree, get_num_coordinates, set_precision
+from shapely.ops import unary_union
 from shapely.geometry import shape, mapping, LineString, Polygon
-from cv2 import RANSAC, COLOR_BGR2GRAY, MORPH_OPEN, THRESH_BINARY_INV
+from numpy import float32, float64, uint8, int32, ones, zeros, array, ndarray, frombuffer, vstack, \
+	column_stack, cumsum, split, roll, arange
+from cv2 import RANSAC, COLOR_BGR2GRAY, COLOR_BGRA2GRAY, MORPH_OPEN, THRESH_BINARY_INV, INTER_AREA, \
+	IMREAD_COLOR, RETR_CCOMP, CHAIN_APPROX_SIMPLE
 from cv2 import findHomography, perspectiveTransform, warpPerspective, morphologyEx, \
-	FlannBasedMatcher, threshold, imwrite, imread, cvtColor, medianBlur, SIFT_create
+	FlannBasedMatcher, threshold, imwrite, imread, imdecode, cvtColor, medianBlur, SIFT_create, resize, \
+	findContours, approxPolyDP, connectedComponentsWithStats, dilate
 
+from paper2gis.context import RunContext, current, timer, vprint
 
-# Module-level verbose flag
-_VERBOSE = False
 
-def vprint(*args, **kwargs):
-	"""Print only if verbose mode is enabled"""
-	if _VERBOSE:
-		print(*args, **kwargs)
+def layout_dpi(geodata):
+	"""
+	* Get the resolution of a layout from the QR code data (layouts that were generated
+	*  before this was recorded are all 96dpi)
+	"""
+	return int(geodata[9]) if len(geodata) > 10 else 96
+
+
+def scale_kernel(size, dpi, odd=False):
+	"""
+	* Scale a kernel size tuned for 96dpi to another resolution (optionally keeping it odd)
+	"""
+	size = max(1, int(round(size * dpi / 96)))
+	return size + 1 if odd and size % 2 == 0 else size
+
+
+def read_image(image_path):
+	"""
+	* Read an image file into a numpy array, including HEIC/HEIF files from iPhones
+	* @author jonnyhuck
+	* @return a numpy array representing the image
+	"""
+
+	# catch HEIC/heif input file
+	if Path(image_path).suffix.lower() in {".heic", ".heif"}:
+		vprint("Converting HEIC/HEIF format...")
+
+		# register HEIF opener with Pillow, open the file and convert to NumPy array
+		pillow_heif.register_heif_opener()
+		return array(Image.open(image_path))
+
+	# read into numpy array
+	return imread(image_path)
+
+
+def load_image(image):
+	"""
+	* Load an image from a file path, encoded image bytes (e.g. an upload) or a numpy array
+	* @author jonnyhuck
+	* @return a numpy array representing the image
+	"""
+
+	# already an array, nothing to do
+	if isinstance(image, ndarray):
+		return image
+
+	# decode bytes in memory, falling back to Pillow for HEIC/HEIF
+	if isinstance(image, (bytes, bytearray, memoryview)):
+		img = imdecode(frombuffer(image, uint8), IMREAD_COLOR)
+		if img is None:
+			pillow_heif.register_heif_opener()
+			img = array(Image.open(BytesIO(image)))
+		return img
+
+	# otherwise a file path (cv2.imread does not raise FileNotFoundError)
+	if not path.isfile(image):
+		raise FileNotFoundError(f"{image} does not exist")
+	return read_image(image)
+
+
+def greyscale(image):
+	"""
+	* Convert an image to greyscale (if it is not already)
+	"""
+	if image.ndim == 2:
+		return image
+	return cvtColor(image, COLOR_BGRA2GRAY if image.shape[2] == 4 else COLOR_BGR2GRAY)
+
+
+def read_qr(image):
+	"""
+	* Read the Paper2GIS metadata from the QR code in an image
+	* @return a list of the values in the QR code, or None if it cannot be read
+	"""
+	codes = decode(image, symbols=[ZBarSymbol.QRCODE])
+	return codes[0].data.decode("utf-8").split(",") if codes else None
+
+
+# a reference layout that is ready for extraction, at the working resolution
+Reference = namedtuple('Reference', ['image', 'geodata', 'dpi', 'working_dpi', 'keypoints', 'descriptors'])
+
+# the settings for an extraction (immutable, so that they can be shared between threads):
+#  - registration: lowe_distance, thresh, kernel, homo_matches, frame
+#  - cleaning: min_area, min_ratio, buffer, uid
+#  - type of output (one at most): convex_hull, centroid, representative_point, exterior, interior, holes
+#  - vectorisation: engine ('shapes' or 'contours'), approx (contour simplification, pixels)
+#  - output simplification: simplify (tolerance), simplify_units ('map' or 'pixels'), precision (map units)
+ExtractSettings = namedtuple('ExtractSettings', ['lowe_distance', 'thresh', 'kernel', 'homo_matches',
+	'frame', 'min_area', 'min_ratio', 'buffer', 'uid', 'convex_hull', 'centroid', 'representative_point',
+	'exterior', 'interior', 'holes', 'engine', 'approx', 'simplify', 'simplify_units', 'precision', 'verbose'],
+	defaults=[0.5, 100, 3, 12, 0, 1000, 0.2, 10, None, False, False, False, False, False, False, 'shapes', 0,
+	0, 'map', 0, False])
+
+
+def extract_settings(settings=None, **options):
+	"""
+	* Get the settings for an extraction: the defaults (or `settings`) with any options
+	*  that are given as keyword arguments (the fields of ExtractSettings) replaced
+	* @return an ExtractSettings
+	"""
+	if settings is None:
+		return ExtractSettings(**options)
+	return settings._replace(**options) if options else settings
+
+
+def prepare_reference(reference, working_dpi=None):
+	"""
+	* Read a reference layout, decode the QR code, scale it to the working resolution
+	*  and detect its SIFT keypoints, so that it can be re-used for any number of targets
+	* 
+	* Parameters:
+	*     reference: the reference layout (file path, image bytes or numpy array)
+	*     working_dpi: the resolution at which to extract maps (default: the resolution of the layout)
+	* 
+	* @author jonnyhuck
+	* @return a Reference
+	"""
+
+	# read in reference image and greyscale
+	reference_img = greyscale(load_image(reference))
+
+	# get metadata from QR code
+	geodata = read_qr(reference_img)
+	if geodata is None:
+		raise Exception('NOT A PAPER2GIS MAP', "Reference image is not a Paper2GIS map")
+	vprint(f"Map CRS: EPSG:{geodata[4]}, UUID: {geodata[-1]}")
+
+	# scale the reference image (and so the homography) to the working resolution
+	dpi = layout_dpi(geodata)
+	if working_dpi is None:
+		working_dpi = dpi
+	if working_dpi != dpi:
+		vprint(f"Working at {working_dpi}dpi (layout is {dpi}dpi)")
+		scale = working_dpi / dpi
+		reference_img = resize(reference_img, None, fx=scale, fy=scale, interpolation=INTER_AREA)
+
+	# find the keypoints and descriptors with SIFT
+	keypoints, descriptors = SIFT_create().detectAndCompute(reference_img, None)
+	return Reference(reference_img, geodata, dpi, working_dpi, keypoints, descriptors)
+
+
+def prepare_target(target, frame=0):
+	"""
+	* Read a target image (a photograph of a used layout), greyscale it and optionally
+	*  add a frame around it (if the map is too close to the edge)
+	* @author jonnyhuck
+	* @return a greyscale numpy array
+	"""
+
+	# read in participant map and greyscale
+	participant_map = greyscale(load_image(target))
+	if frame > 0:
+		vprint(f"Adding frame (multiplier: {frame})")
+		# make a white background
+		h, w = participant_map.shape
+		
+		# make a white background that is 2 * frame larger then the image in each dimension
+		frame_multiplier = 1 + frame * 2
+		frame_background = zeros([int(h * frame_multiplier), int(w * frame_multiplier)], dtype=uint8)
+		frame_background.fill(127)
+
+		# paste the original image onto the new background, leaving a frame
+		y_offset, x_offset = int(frame * h), int(frame * w)
+		y_end, x_end = h + y_offset, w + x_offset
+		frame_background[y_offset:y_end, x_offset:x_end] = participant_map
+		
+		# overwrite the participant map
+		participant_map = frame_background
+	return participant_map
 
 
-def extract_map(reference_img, target_img, lowe_distance, homo_matches):
+def extract_map(reference_img, target_img, lowe_distance, homo_matches, reference_features=None):
 	"""
 	* Identify one image inside another, extract and perspective transform
+	*  (the reference keypoints and descriptors can be passed if they are already known)
 	* @author jonnyhuck
 	* @return a numpy array representing the extracted and rectified map
 	"""
@@ -60,7 +232,7 @@ def extract_map(reference_img, target_img, lowe_distance, homo_matches):
 	vprint("Detecting keypoints with SIFT...")
 	sift = SIFT_create()
 	kp1, des1 = sift.detectAndCompute(target_img, None)
-	kp2, des2 = sift.detectAndCompute(reference_img, None)
+	kp2, des2 = reference_features if reference_features else sift.detectAndCompute(reference_img, None)
 	vprint(f"Found {len(kp1)} keypoints in target, {len(kp2)} in reference")
 
 	# do some FLANN matching
@@ -101,33 +273,43 @@ def extract_map(reference_img, target_img, lowe_distance, homo_matches):
 	return warpPerspective(target_img, M, (cols, rows))
 
 
-def processImage(referenceImg, participantMap, lowe_distance,
-	homo_matches, geodata, thresh, kernel, demo):
+def processImage(reference, participantMap, lowe_distance,
+	homo_matches, thresh, kernel, demo):
 	"""
 	* The image processing steps for extracting the markup data from the image
+	* 
+	* The map is extracted at the working resolution of the (prepared) reference, so
+	*  that the cost of processing does not depend on the print resolution. The blur
+	*  and opening kernel sizes are given for 96dpi and scaled to match.
 	* @author jonnyhuck
 	* @return a binary numpy array of (255) markup and (0) background
 	"""
+	geodata, working_dpi = reference.geodata, reference.working_dpi
+	scale = working_dpi / reference.dpi
 
 	# extract the map from the target image
-	homoMap = extract_map(referenceImg, participantMap, lowe_distance, homo_matches)
+	with timer('register'):
+		homoMap = extract_map(reference.image, participantMap, lowe_distance, homo_matches,
+			(reference.keypoints, reference.descriptors))
 	if demo:
 		imwrite("./demo/3.warped.png", homoMap)
 
 	# crop homogrified result
-	cropped_map = homoMap[int(geodata[6]):int(geodata[8]), int(geodata[5]):int(geodata[7])]
+	x0, y0, x1, y1 = [ int(int(c) * scale) for c in geodata[5:9] ]
+	cropped_map = homoMap[y0:y1, x0:x1]
 	if demo:
 		imwrite("./demo/4.cropped.png", cropped_map)
 
 	# threshold the image to extract markup
 	vprint("Extracting markup with thresholding and morphology...")
-	_, thresh_map = threshold(medianBlur(cropped_map, 7), thresh, 255, THRESH_BINARY_INV)
+	_, thresh_map = threshold(medianBlur(cropped_map, scale_kernel(7, working_dpi, odd=True)), thresh, 255, THRESH_BINARY_INV)
 	if demo:
 		imwrite("./demo/5.thresholded.png", thresh_map)
 
 	# if kernel is 0 then skip this step
 	if kernel > 0:
 		# erode and dilate the image to remove noise from the map alignment
+		kernel = scale_kernel(kernel, working_dpi)
 		opened_map = morphologyEx(thresh_map, MORPH_OPEN, ones((kernel, kernel), uint8))
 		if demo:
 			imwrite("./demo/6.opened.png", opened_map)
@@ -138,280 +320,670 @@ def processImage(referenceImg, participantMap, lowe_distance,
 	return opened_map
 
 
-def writeTiff(output, opened_map, geodata):
+def georeference(geodata, array_shape):
 	"""
-	* Write a numpy array to a GeoTiff - this is mostly here for backward compatibility,
-	*  expected behaviour is to output to shapefile as this has data cleaning steps to
-	*  improve the output
+	* Get the affine transform and crs of an extracted dataset from the QR code data
+	*  of its layout and the shape (rows, columns) of the dataset
+	* @return the affine transform and the crs (e.g. 'EPSG:3857')
+	"""
+	transform = from_bounds(float(geodata[0]), float(geodata[1]), float(geodata[2]),
+		float(geodata[3]), array_shape[1], array_shape[0])
+	return transform, f"EPSG:{geodata[4]}"
+
+
+def extract_mask(reference, target, lowe_distance=0.5, thresh=100, kernel=3, homo_matches=12,
+	frame=0, demo=False):
+	"""
+	* Extract the markup from a target image in memory
+	* 
+	* Parameters:
+	*     reference: a prepared Reference (see prepare_reference)
+	*     target: the target image (file path, image bytes or numpy array)
+	* 
 	* @author jonnyhuck
+	* @return a binary numpy array of (255) markup and (0) background, its affine
+	*  transform and its crs (e.g. 'EPSG:3857')
 	"""
 
-	vprint(f"\nWriting output to GeoTIFF:")
-	vprint(f"  - Dimensions: {opened_map.shape[1]} x {opened_map.shape[0]} pixels")
-	vprint(f"  - CRS: EPSG:{geodata[4]}")
+	# read in the participant map
+	with timer('read'):
+		participant_map = prepare_target(target, frame)
+	if demo:
+		imwrite("./demo/2.target.png", participant_map)
 
-	# output dataset to raster
-	with rio_open(output, 'w', driver='GTiff', height=opened_map.shape[0],
-		width=opened_map.shape[1], count=1, dtype='uint8', crs="EPSG:" + geodata[4],
-		transform=from_bounds(float(geodata[0]), float(geodata[1]), float(geodata[2]),
-			float(geodata[3]), opened_map.shape[1], opened_map.shape[0])
-	) as out:
-		out.write(opened_map, 1)
+	# verify that the target image matches the reference
+	# (this never seems to manage to read it, so carry on if it can't!)
+	tmp_geodata = read_qr(participant_map)
+	if tmp_geodata is not None and reference.geodata[-1] != tmp_geodata[-1]:
+		raise Exception('WRONG REFERENCE', "Target image does not match reference image")
+
+	# run the image processing to get binary result array
+	with timer('process'):
+		opened_map = processImage(reference, participant_map, lowe_distance,
+			homo_matches, thresh, kernel, demo)
+
+	# georeference the result
+	return (opened_map, *georeference(reference.geodata, opened_map.shape))
 
 
-def cleanWriteShapefile(output, opened_map, geodata, buffer, min_area, min_ratio, 
-						convex_hull, centroid, representative_point, exterior, interior, uid):
+def pixel_edge_ring(contour):
 	"""
-	* Clean an output dataset and write to a shapefile
+	* Turn a contour traced on the pixel corner grid (see contour_polygons) into a ring that
+	*  follows the pixel edges: findContours cuts across each inner corner of the staircase
+	*  with a diagonal step between the middles of two pixel edges, so the pixel corner
+	*  between them (the end with even coordinates) is put back, and then any vertex that
+	*  lies on a straight line between its neighbours is removed
+	* @return an (n, 2) array of vertices on the corner grid
+	"""
+	pts = contour.reshape(-1, 2)
+	step = roll(pts, -1, axis=0) - pts
+
+	# put back the corner cut by each diagonal step
+	diagonal = (abs(step[:, 0]) == 1) & (abs(step[:, 1]) == 1)
+	if diagonal.any():
+		corners = column_stack((pts[:, 0] + step[:, 0], pts[:, 1]))
+		odd = corners[:, 0] % 2 == 1
+		corners[odd] = column_stack((pts[odd, 0], pts[odd, 1] + step[odd, 1]))
+		out = zeros((len(pts) + int(diagonal.sum()), 2), pts.dtype)
+		index = arange(len(pts)) + cumsum(diagonal) - diagonal
+		out[index] = pts
+		out[index[diagonal] + 1] = corners[diagonal]
+		pts = out
+
+	# remove the vertices along straight lines
+	before, after = pts - roll(pts, 1, axis=0), roll(pts, -1, axis=0) - pts
+	return pts[before[:, 0] * after[:, 1] - before[:, 1] * after[:, 0] != 0]
+
+
+def contour_polygons(opened_map, transform, approx=0):
+	"""
+	* Vectorise the markup in a binary image using OpenCV contours (an alternative to 
+	*  rasterio.features.shapes). The contour hierarchy gives the holes in each polygon,
+	*  the contours can be simplified with approxPolyDP (`approx` is the tolerance in 
+	*  pixels) and all of the coordinates are transformed to the map crs in a single
+	*  vectorised affine step.
+	* 
+	* findContours joins pixels that only touch diagonally, so the markup is first split
+	*  into 4-connected blobs (as in shapes()) and each blob is traced separately, so that
+	*  both engines give the same features. findContours also traces the centres of the 
+	*  edge pixels rather than their edges, so each blob is traced on a grid of twice the
+	*  resolution that holds the pixel corners and the middle of each pixel edge (a point 
+	*  is set if it is on or in any pixel of the blob), and the corners that findContours
+	*  cuts across are put back (see pixel_edge_ring). Shells and holes then both follow
+	*  the pixel edges exactly, as in shapes(). Blobs whose rings do not make a valid
+	*  polygon are vectorised with shapes() instead
 	* @author jonnyhuck
+	* @return an iterator of shapely Polygons in map coordinates
 	"""
 
-	vprint(f"Vectorizing and cleaning (min_area={min_area}, min_ratio={min_ratio}, buffer={buffer})...")
+	# split the markup into 4-connected blobs
+	n, labels, stats, _ = connectedComponentsWithStats((opened_map == 255).astype(uint8), connectivity=4)
+
+	# trace the outer boundary and holes of each blob
+	contours = []
+	blobs = []
+	corner_kernel = ones((3, 3), uint8)
+	for k in range(1, n):
+		x, y, w, h = [ int(v) for v in stats[k, :4] ]
+
+		# crop to the blob, with a blank border so that it is not cut by the edge of the crop
+		blob = zeros((h + 2, w + 2), uint8)
+		blob[1:-1, 1:-1] = labels[y:y+h, x:x+w] == k
+
+		# the pixel corner grid (pixel centres are at odd positions, corners at even ones)
+		grid = zeros((2 * h + 5, 2 * w + 5), uint8)
+		grid[1::2, 1::2] = blob
+		grid = dilate(grid, corner_kernel)
+		grid_contours, hierarchy = findContours(grid, RETR_CCOMP, CHAIN_APPROX_SIMPLE)
+		rings = [ pixel_edge_ring(c) for c in grid_contours ]
+
+		# simplify in pixel space (the grid is at twice the resolution)
+		if approx > 0:
+			rings = [ approxPolyDP(r.reshape(-1, 1, 2).astype(int32), approx * 2, True).reshape(-1, 2) for r in rings ]
+
+		# the blob is one piece, so has one outer boundary (no parent) and the rest are holes
+		outer = [ i for i, row in enumerate(hierarchy[0]) if row[3] == -1 ][0]
+		holes = [ r for i, r in enumerate(rings) if i != outer ]
+		if len(rings[outer]) < 3 or any(len(r) < 3 for r in holes) or not Polygon(rings[outer], holes).is_valid:
+			for s, v in shapes(blob, mask=blob == 1, transform=transform * Affine.translation(x - 1, y - 1)):
+				yield shape(s)
+			continue
+		blobs.append((len(contours), len(rings)))
+		contours += [ r / 2 + (x - 1, y - 1) for r in [rings[outer]] + holes ]
+
+	if not contours:
+		return
+
+	# transform every vertex of every contour to map coordinates at once
+	px = vstack(contours).astype(float64)
+	coords = column_stack((
+		transform.a * px[:, 0] + transform.b * px[:, 1] + transform.c,
+		transform.d * px[:, 0] + transform.e * px[:, 1] + transform.f))
+	rings = split(coords, cumsum([ len(c) for c in contours ])[:-1])
+
+	# build a polygon from each outer boundary and its holes
+	for first, count in blobs:
+		yield Polygon(rings[first], rings[first + 1:first + count])
+
+
+def shapes_polygons(opened_map, transform):
+	"""
+	* Vectorise the markup in a binary image using rasterio.features.shapes
+	* @return an iterator of shapely Polygons in map coordinates
+	"""
 
 	# make a mask of which cells we want to extract
 	mask = opened_map == 255
 
 	# extract the masked cells as georeferenced vector shapes
-	results = ({'properties': {'raster_val': v}, 'geometry': s} for i, (s, v) in
-		enumerate(shapes(opened_map, mask=mask, transform=from_bounds(float(geodata[0]),
-		float(geodata[1]), float(geodata[2]), float(geodata[3]), opened_map.shape[1],
-		opened_map.shape[0]))))
+	for s, v in shapes(opened_map, mask=mask, transform=transform):
+		yield shape(s)
 
-	# set geometry type for shapefile
-	geom_type = 'Point' if any([centroid, representative_point]) else 'Polygon'
 
-	# open shapefile for writing
-	feature_count = 0
-	dropped_count = {'small': 0, 'ratio': 0, 'edge': 0}
-	
-	with fio_open(output, 'w', driver="ESRI Shapefile", crs=f"EPSG:{geodata[4]}",
-		schema={'geometry': geom_type, 'properties': {'area':'float', 'uid':'int'}}) as out:
+def fill_holes(polygons):
+	"""
+	* Make polygons from marked boundaries, where boundaries that are drawn within another
+	*  boundary become holes in it (and boundaries within those become islands, and so on)
+	* @return a list of shapely Polygons
+	"""
 
-		#  this would write the raw records - the equivalent of what you would get in the raster output
-		# out.writerecords(results)
-
-		# construct aoi boundary zone
-		envelope = [ float(x) for x in geodata[:4] ]
-		edge = LineString([
-			(envelope[0], envelope[1]), # bl
-			(envelope[2], envelope[1]), # br
-			(envelope[2], envelope[3]), # tr
-			(envelope[0], envelope[3]), # tl
-			(envelope[0], envelope[1])  # bl
-			]).buffer(buffer)
-
-		# access the variable (loop through each feature in this case)
-		for feature in results:
-
-			# convert the geometry to shapely format
-			geom = shape(feature['geometry'])
-
-			# if too small, drop (either convex hull or regular geom)
-			the_area = geom.convex_hull.area if convex_hull else geom.area
-			if the_area < min_area:
-				dropped_count['small'] += 1
-				continue
+	# the area inside each marked boundary, largest first
+	filled = sorted(polygons, key=lambda p: p.area, reverse=True)
 
-			# if wrong ratio between width & height of bounding box, drop
-			sides = [geom.bounds[2] - geom.bounds[0], geom.bounds[3] - geom.bounds[1]]
-			if min(sides) / max(sides) < min_ratio:
-				dropped_count['ratio'] += 1
+	# how many other boundaries is each one inside? (even = a shell, odd = a hole)
+	depth = [ sum(1 for j in range(i) if filled[j].contains(filled[i])) for i in range(len(filled)) ]
+
+	# add the boundaries directly inside each shell as its holes
+	result = []
+	for i, shell in enumerate(filled):
+		if depth[i] % 2:
+			continue
+		holes = [ filled[j] for j in range(i + 1, len(filled)) if depth[j] == depth[i] + 1 and shell.contains(filled[j]) ]
+		result.append(shell.difference(unary_union(holes)) if holes else shell)
+	return result
+
+
+def geometry_type(centroid=False, representative_point=False):
+	"""
+	* Get the geometry type of the features for the requested type of output
+	"""
+	return 'Point' if any([centroid, representative_point]) else 'Polygon'
+
+
+def simplify_geometries(geoms, tolerance):
+	"""
+	* Simplify geometries (Douglas-Peucker, with `tolerance` as the maximum distance in map
+	*  units that an outline can move) without changing the topological relationship
+	*  between any pair of them (e.g. features that were apart cannot come to overlap,
+	*  and features that touched still touch). Any pair whose relationship would change
+	*  is left unsimplified
+	* @return a list of the simplified geometries
+	"""
+	simplified = [ g.simplify(tolerance, preserve_topology=True) for g in geoms ]
+
+	# each outline moves by at most `tolerance`, so only pairs that are within twice that of
+	#  each other can change, whichever of the two (original or simplified) each ends up as
+	i, j = STRtree(geoms).query(geoms, predicate='dwithin', distance=2 * tolerance)
+	candidates = [ (a, b) for a, b in zip(i.tolist(), j.tolist()) if a < b ]
+
+	# restore the originals until every pair has the same relationship as before (re-checking
+	#  every pair after a feature is restored, as its original may conflict with another)
+	changed = True
+	while changed:
+		changed = False
+		for a, b in candidates:
+			if simplified[a] is geoms[a] and simplified[b] is geoms[b]:
 				continue
+			if simplified[a].relate(simplified[b]) != geoms[a].relate(geoms[b]):
+				simplified[a], simplified[b] = geoms[a], geoms[b]
+				changed = True
+	return simplified
 
-			# if intersects edge, clip it
-			if geom.intersects(edge):
-				dropped_count['edge'] += 1
-				# TODO: subdivide into individual geoms
-				geom = geom.difference(edge)
 
-			# make sure that we haven't ended up with an empty geometry
-			if geom.is_empty:
+def simplify_features(features, tolerance=0, precision=0):
+	"""
+	* Simplify the geometries of a list of features and snap their coordinates to a grid
+	* 
+	* Parameters:
+	*     tolerance: the maximum distance (map units) that an outline can move (0 = no simplification)
+	*     precision: the size of the grid to snap coordinates to in map units (0 = no snapping)
+	* 
+	* @author jonnyhuck
+	* @return the simplified features (with the area of polygons updated to match)
+	"""
+	with timer('simplify'):
+		geoms = [ shape(f['geometry']) for f in features ]
+		before = int(get_num_coordinates(geoms).sum()) if geoms else 0
+
+		# simplify, keeping the relationships between neighbouring features
+		if tolerance > 0 and geoms:
+			geoms = simplify_geometries(geoms, tolerance)
+
+		# snap to the grid (this keeps polygons valid, but may remove very small ones)
+		if precision > 0 and geoms:
+			geoms = list(set_precision(geoms, precision))
+
+		# drop anything that has collapsed, and update the area of the rest
+		simplified = []
+		for f, g in zip(features, geoms):
+			if g.is_empty:
 				continue
+			properties = dict(f['properties'], area=g.area) if g.geom_type in ['Polygon', 'MultiPolygon'] else f['properties']
+			simplified.append({'geometry': mapping(g), 'properties': properties})
+		after = int(get_num_coordinates(geoms).sum()) if geoms else 0
 
-			# if convex hull is desired, save that
-			if (convex_hull):
-				out.write({'geometry': mapping(geom.convex_hull),
-					'properties': {'area': geom.convex_hull.area, 'uid': uid}})
-				feature_count += 1
-			
-			# if centroid is desired, save that
-			elif (centroid):
-				out.write({'geometry': mapping(geom.centroid),
-					'properties': {'area': 0, 'uid': uid}})
-				feature_count += 1
-
-			# if rep point is desired, save that
-			elif (representative_point):
-				out.write({'geometry': mapping(geom.representative_point()),
-					'properties': {'area': 0, 'uid': uid}})
-				feature_count += 1
+	vprint(f"  - Simplified (tolerance={tolerance}, precision={precision}):")
+	vprint(f"    * Vertices: {before} -> {after} ({100 - after / before * 100 if before else 0:.1f}% fewer)")
+	vprint(f"    * Features collapsed: {len(features) - len(simplified)}")
+	return simplified
+
+
+def iter_features(opened_map, transform, *, settings=None, **options):
+	"""
+	* Vectorise, clean and (optionally) simplify an extracted dataset. The settings can be
+	*  given as an ExtractSettings and/or as keyword arguments (e.g. min_area=500), and
+	*  must be given by keyword
+	* @author jonnyhuck
+	* @return an iterator of GeoJSON-like features ({'geometry': ..., 'properties': ...})
+	"""
+	s = extract_settings(settings, **options)
+	features = clean_features(opened_map, transform, s)
+
+	# simplification needs all of the features at once (to keep neighbours topologically consistent)
+	if s.simplify > 0 or s.precision > 0:
+		tolerance = s.simplify * abs(transform.a) if s.simplify_units == 'pixels' else s.simplify
+		features = iter(simplify_features(list(features), tolerance, s.precision))
+	return features
+
+
+def clean_features(opened_map, transform, settings):
+	"""
+	* Vectorise and clean an extracted dataset (see iter_features)
+	* @author jonnyhuck
+	* @return an iterator of GeoJSON-like features ({'geometry': ..., 'properties': ...})
+	"""
+	s = settings
+	buffer, min_area, min_ratio, uid = s.buffer, s.min_area, s.min_ratio, s.uid
+	convex_hull, centroid, representative_point = s.convex_hull, s.centroid, s.representative_point
+	exterior, interior, holes, engine = s.exterior, s.interior, s.holes, s.engine
+
+	vprint(f"Vectorizing ({engine}) and cleaning (min_area={min_area}, min_ratio={min_ratio}, buffer={buffer})...")
+
+	# extract the markup as georeferenced vector shapes
+	if engine == 'contours':
+		results = contour_polygons(opened_map, transform, s.approx)
+	elif engine == 'shapes':
+		results = shapes_polygons(opened_map, transform)
+	else:
+		raise ValueError(f"unknown vectorisation engine: {engine} (use 'shapes' or 'contours')")
+
+	# construct aoi boundary zone
+	dropped_count = {'small': 0, 'ratio': 0, 'edge': 0}
+	envelope = array_bounds(opened_map.shape[0], opened_map.shape[1], transform)
+	edge = LineString([
+		(envelope[0], envelope[1]), # bl
+		(envelope[2], envelope[1]), # br
+		(envelope[2], envelope[3]), # tr
+		(envelope[0], envelope[3]), # tl
+		(envelope[0], envelope[1])  # bl
+		]).buffer(buffer)
+
+	# access the variable (loop through each feature in this case)
+	boundaries = []
+	for geom in results:
+
+		# if too small, drop (either convex hull or regular geom)
+		the_area = geom.convex_hull.area if convex_hull else geom.area
+		if the_area < min_area:
+			dropped_count['small'] += 1
+			continue
+
+		# if wrong ratio between width & height of bounding box, drop
+		sides = [geom.bounds[2] - geom.bounds[0], geom.bounds[3] - geom.bounds[1]]
+		if min(sides) / max(sides) < min_ratio:
+			dropped_count['ratio'] += 1
+			continue
+
+		# if intersects edge, clip it
+		if geom.intersects(edge):
+			dropped_count['edge'] += 1
+			# TODO: subdivide into individual geoms
+			geom = geom.difference(edge)
+
+		# make sure that we haven't ended up with an empty geometry
+		if geom.is_empty:
+			continue
+
+		# if convex hull is desired, save that
+		if (convex_hull):
+			yield {'geometry': mapping(geom.convex_hull),
+				'properties': {'area': geom.convex_hull.area, 'uid': uid}}
+		
+		# if centroid is desired, save that
+		elif (centroid):
+			yield {'geometry': mapping(geom.centroid),
+				'properties': {'area': 0, 'uid': uid}}
+
+		# if rep point is desired, save that
+		elif (representative_point):
+			yield {'geometry': mapping(geom.representative_point()),
+				'properties': {'area': 0, 'uid': uid}}
+		
+		# extract exterior ring from polygon
+		elif (exterior):
+
+			# handle MultiPolygons
+			geoms = geom.geoms if geom.geom_type == 'MultiPolygon' else [geom]
+			for g in geoms:
 			
-			# extract exterior ring from polygon
-			elif (exterior):
-
-				# handle MultiPolygons
-				geoms = geom.geoms if geom.geom_type == 'MultiPolygon' else [geom]
-				for g in geoms:
-				
-					# extract the exterior ring and convert to polygon
-					polygon = Polygon(g.exterior.coords)
-					out.write({'geometry': mapping(polygon),
-						'properties': {'area': geom.area, 'uid': uid}})
-					feature_count += 1
+				# extract the exterior ring and convert to polygon
+				polygon = Polygon(g.exterior.coords)
+				yield {'geometry': mapping(polygon),
+					'properties': {'area': geom.area, 'uid': uid}}
+		
+		# extract interior ring from polygon
+		elif (interior):
+
+			# handle MultiPolygons
+			geoms = geom.geoms if geom.geom_type == 'MultiPolygon' else [geom]
+			for g in geoms:
 			
-			# extract interior ring from polygon
-			elif (interior):
-
-				# handle MultiPolygons
-				geoms = geom.geoms if geom.geom_type == 'MultiPolygon' else [geom]
-				for g in geoms:
-				
-					# extract the interior ring and convert to polygon
-					for int_geom in geom.interiors:
-						polygon = Polygon(int_geom.coords)
-						out.write({'geometry': mapping(polygon),
-							'properties': {'area': geom.area, 'uid': uid}})
-						feature_count += 1
-
-			# TODO: have a `holes` option that gets all polygons within each 
-			# 	other polygon and adds them as holes to the constructor (or
-			# 	differences them)
-
-			# otherwise just save the raw geometry
-			else:
-				out.write({'geometry': mapping(geom),
-					'properties': {'area': geom.area, 'uid': uid}})
-				feature_count += 1
-	
-	vprint(f"  - Features written: {feature_count}")
+				# extract the interior ring and convert to polygon
+				for int_geom in g.interiors:
+					polygon = Polygon(int_geom.coords)
+					yield {'geometry': mapping(polygon),
+						'properties': {'area': geom.area, 'uid': uid}}
+
+		# collect the area within each boundary, to be nested once they are all known
+		elif (holes):
+			geoms = geom.geoms if geom.geom_type == 'MultiPolygon' else [geom]
+			boundaries += [ Polygon(g.exterior.coords) for g in geoms ]
+
+		# otherwise just save the raw geometry
+		else:
+			yield {'geometry': mapping(geom),
+				'properties': {'area': geom.area, 'uid': uid}}
+
+	# make polygons with holes from the nested boundaries
+	for polygon in fill_holes(boundaries):
+		yield {'geometry': mapping(polygon),
+			'properties': {'area': polygon.area, 'uid': uid}}
+
 	vprint(f"  - Features dropped:")
 	vprint(f"    * Area too small: {dropped_count['small']}")
 	vprint(f"    * Intersected edge: {dropped_count['edge']}")
 	vprint(f"    * Aspect ratio too small: {dropped_count['ratio']}")
+
+
+def settings_mask(reference, target, settings, demo=False):
+	"""
+	* Extract the markup from a target image using the registration options in an ExtractSettings
+	"""
+	s = settings
+	return extract_mask(reference, target, lowe_distance=s.lowe_distance, thresh=s.thresh, kernel=s.kernel,
+		homo_matches=s.homo_matches, frame=s.frame, demo=demo)
+
+
+def extract_features(reference, target, *, settings=None, **options):
+	"""
+	* Extract the markup from a target image in memory as cleaned vector features
+	* 
+	* Parameters:
+	*     reference: a prepared Reference (see prepare_reference)
+	*     target: the target image (file path, image bytes or numpy array)
+	*     settings, options: an ExtractSettings and/or its fields (keyword arguments only)
+	* 
+	* @author jonnyhuck
+	* @return an iterator of GeoJSON-like features and the crs (e.g. 'EPSG:3857')
+	"""
+	s = extract_settings(settings, **options)
+	opened_map, transform, crs = settings_mask(reference, target, s)
+	return iter_features(opened_map, transform, settings=s), crs
+
+
+def writeTiff(output, opened_map, transform, crs):
+	"""
+	* Write a numpy array to a GeoTiff - this is mostly here for backward compatibility,
+	*  expected behaviour is to output to shapefile as this has data cleaning steps to
+	*  improve the output
+	* @author jonnyhuck
+	"""
+
+	vprint(f"\nWriting output to GeoTIFF:")
+	vprint(f"  - Dimensions: {opened_map.shape[1]} x {opened_map.shape[0]} pixels")
+	vprint(f"  - CRS: {crs}")
+
+	# output dataset to raster
+	with rio_open(output, 'w', driver='GTiff', height=opened_map.shape[0],
+		width=opened_map.shape[1], count=1, dtype='uint8', crs=crs, transform=transform
+	) as out:
+		out.write(opened_map, 1)
+
+
+def writeShapefile(output, features, crs, geom_type='Polygon'):
+	"""
+	* Write an iterator of GeoJSON-like features to a shapefile
+	* @author jonnyhuck
+	"""
+
+	# open shapefile for writing
+	feature_count = 0
+	with fio_open(output, 'w', driver="ESRI Shapefile", crs=crs,
+		schema={'geometry': geom_type, 'properties': {'area':'float', 'uid':'int'}}) as out:
+		for feature in features:
+			out.write(feature)
+			feature_count += 1
+
+	vprint(f"  - Features written: {feature_count}")
 	vprint(f"  - Successfully written to {output}")
 
 
-def run_extract(reference, target, output='out.shp', lowe_distance=0.5, thresh=100,
-	kernel=3, homo_matches=12, frame=0, min_area=1000, min_ratio=0.2, buffer=10, uid=None, convex_hull=False,
-	centroid=False, representative_point=False, exterior=False, interior=False, demo=False, verbose=False):
+def cleanWriteShapefile(output, opened_map, transform, crs, settings):
 	"""
-	* Main function: this runs the map extraction, resulting in a file being written
-	*  to the desired location
+	* Clean an output dataset and write to a shapefile
 	* @author jonnyhuck
 	"""
+	features = iter_features(opened_map, transform, settings=settings)
+	writeShapefile(output, features, crs, geometry_type(settings.centroid, settings.representative_point))
 
-	# Set module-level verbose flag
-	global _VERBOSE
-	_VERBOSE = verbose
-	
-	vprint(f"\nExtracting markup: {target} -> {output}")
-	vprint(f"Parameters: threshold={thresh}, kernel={kernel}, lowe_distance={lowe_distance}, min_matches={homo_matches}")
+
+def writeOutput(output, opened_map, transform, crs, settings):
+	"""
+	* Write an extracted dataset to a GeoTiff or (cleaned) shapefile, depending upon the
+	*  extension of the output file
+	* @author jonnyhuck
+	"""
+	with timer('write'):
+
+		# output to a raster if the output file extension is .tif (no cleaning)
+		if output[-4:] == ".tif":
+			# TODO: convert to vector, clean then rasterise
+			writeTiff(output, opened_map, transform, crs)
+
+		# clean the dataset and output to a vector if the output file extension is .shp
+		elif output[-4:] == ".shp":
+			cleanWriteShapefile(output, opened_map, transform, crs, settings)
+
+
+def check_output_extension(extension):
+	"""
+	* Make sure that an output file extension (e.g. '.shp') is suitable
+	"""
+	if extension not in [".tif", ".shp"]:
+		raise ValueError(f"output data file must be .tif (for a raster output) or .shp (for vector output). You used {extension}")
+
+
+def check_output_options(output, settings):
+	"""
+	* Make sure that the requested output is valid before doing any work
+	"""
+	s = settings
 
 	# make sure there are not any conflicting output options specified
-	if sum([convex_hull, centroid, representative_point, exterior, interior]) > 1:
-		raise AttributeError(f"you have requested more than one type of output - please select only one of convex_hull, centroid, representative_point or boundary")
+	if sum([s.convex_hull, s.centroid, s.representative_point, s.exterior, s.interior, s.holes]) > 1:
+		raise AttributeError(f"you have requested more than one type of output - please select only one of convex_hull, centroid, representative_point, exterior, interior or holes")
 
-	# check input files exist (cv2.imread does not raise FileNotFoundError)
-	if not path.isfile(reference):
-		raise FileNotFoundError(f"{reference} does not exist")
-	if not path.isfile(target):
-		raise FileNotFoundError(f"{target} does not exist")
+	# make sure that the vectorisation engine exists
+	if s.engine not in ['shapes', 'contours']:
+		raise ValueError(f"vectorisation engine must be 'shapes' or 'contours'. You used {s.engine}")
+
+	# make sure that the simplification units exist
+	if s.simplify_units not in ['map', 'pixels']:
+		raise ValueError(f"simplification units must be 'map' or 'pixels'. You used {s.simplify_units}")
 
 	# make sure that the output file extension is suitable
-	if output[-4:] not in [".tif", ".shp"]:
-		print(f"output data file must be .tif (for a raster output) or .shp (for vector output). You used {output[-4:]}")
-		exit()
+	if output is not None:
+		check_output_extension(output[-4:])
 
-	# output demo info & empty demo directory
-	if demo:
 
-		# make sure demo folder exists
-		if not path.exists('./demo'):
-			makedirs('./demo')
+def run_extract(reference, target, output='out.shp', *, demo=False, working_dpi=None, settings=None, **options):
+	"""
+	* Main function: this runs the map extraction, resulting in a file being written
+	*  to the desired location. The reference can be a file path or a prepared Reference,
+	*  and the target can be a file path, image bytes or an image array (e.g. a frame 
+	*  selected from a video by the pre-screen). The settings can be given as an 
+	*  ExtractSettings and/or as keyword arguments (e.g. thresh=100, kernel=0, verbose=True).
+	*  Everything after the output must be given by keyword
+	* @author jonnyhuck
+	* @return a dict of the time (seconds) spent in each stage
+	"""
+	s = extract_settings(settings, **options)
 
-		# make sure demo folder is empty
-		for f in glob("./demo/*.png"):
-			remove(f)
+	# label for the target in messages (it may be a path or an image)
+	target_name = target if isinstance(target, str) else "<image>"
 
-		# print initial demo information
-		print(f"reference: {reference}")
-		print(f"target: {target}")
-		print(f"output: {output}")
+	# logging and metrics for this run only
+	with RunContext(s.verbose) as ctx:
+		vprint(f"\nExtracting markup: {target_name} -> {output}")
+		vprint(f"Parameters: threshold={s.thresh}, kernel={s.kernel}, lowe_distance={s.lowe_distance}, min_matches={s.homo_matches}")
 
-	# read in reference image and greyscale
-	reference_img = cvtColor(imread(reference), COLOR_BGR2GRAY)
-	if demo:
-		imwrite("./demo/1.reference.png", reference_img)
+		# make sure that the requested output is valid
+		check_output_options(output, s)
 
-	# catch HEIC/heif input file
-	if Path(target).suffix.lower() in {".heic", ".heif"}:
-		vprint("Converting HEIC/HEIF format...")
-		if demo and not _VERBOSE:
-			print("Converting HEIC/HEIF format...")
-		
-		# register HEIF opener with Pillow and open the file
-		pillow_heif.register_heif_opener()
-		pil_img = Image.open(target)
+		# check target file exists before doing any work
+		if isinstance(target, str) and not path.isfile(target):
+			raise FileNotFoundError(f"{target} does not exist")
 
-		# convert to NumPy array
-		ref_np = array(pil_img)
-	else:
+		# output demo info & empty demo directory
+		if demo:
 
-		# read into numpy array
-		ref_np = imread(target)
+			# make sure demo folder exists
+			if not path.exists('./demo'):
+				makedirs('./demo')
 
-	# read in participant map and greyscale
-	participant_map = cvtColor(ref_np, COLOR_BGR2GRAY)
-	if frame > 0:
-		vprint(f"Adding frame (multiplier: {frame})")
-		# make a white background
-		h, w = participant_map.shape
-		
-		# make a white background that is 2 * frame larger then the image in each dimension
-		frame_multiplier = 1 + frame * 2
-		frame_background = zeros([int(h * frame_multiplier), int(w * frame_multiplier)], dtype=uint8)
-		frame_background.fill(127)
+			# make sure demo folder is empty
+			for f in glob("./demo/*.png"):
+				remove(f)
 
-		# paste the original image onto the new background, leaving a frame
-		y_offset, x_offset = int(frame * h), int(frame * w)
-		y_end, x_end = h + y_offset, w + x_offset
-		frame_background[y_offset:y_end, x_offset:x_end] = participant_map
-		
-		# overwrite the participant map
-		participant_map = frame_background
-	if demo:
-		imwrite("./demo/2.target.png", participant_map)
+			# print initial demo information
+			print(f"reference: {reference if isinstance(reference, str) else '<reference>'}")
+			print(f"target: {target_name}")
+			print(f"output: {output}")
 
-	# get metadata from QR code
-	try:
-		geodata = decode(reference_img, symbols=[ZBarSymbol.QRCODE])[0].data.decode("utf-8").split(",")
-		vprint(f"Map CRS: EPSG:{geodata[4]}, UUID: {geodata[-1]}")
-		if demo and not _VERBOSE:
-			print(f"Map CRS: EPSG:{geodata[4]}, UUID: {geodata[-1]}")
-	except IndexError:
-		raise Exception('NOT A PAPER2GIS MAP', "Reference image is not a Paper2GIS map")
+		# read in the reference image (unless it has already been prepared)
+		if not isinstance(reference, Reference):
+			reference = prepare_reference(reference, working_dpi)
+		if demo:
+			imwrite("./demo/1.reference.png", reference.image)
+			if not current().verbose:
+				print(f"Map CRS: EPSG:{reference.geodata[4]}, UUID: {reference.geodata[-1]}")
+				if isinstance(target, str) and Path(target).suffix.lower() in {".heic", ".heif"}:
+					print("Converting HEIC/HEIF format...")
 
-	# verify that the target image matches the reference
-	try:
-		tmp_geodata = decode(participant_map, symbols=[ZBarSymbol.QRCODE])[0].data.decode("utf-8").split(",")
-		if geodata[-1] != tmp_geodata[-1]:
-			raise Exception('WRONG REFERENCE', "Target image does not match reference image")
-	except IndexError:
-		# print("WARNING - can't read QR code in target image")
-		pass	# never seems to manage to read it!
+		# run the image processing to get binary result array
+		opened_map, transform, crs = settings_mask(reference, target, s, demo)
 
-	# run the image processing to get binary result array
-	opened_map = processImage(reference_img, participant_map, lowe_distance,
-		homo_matches, geodata, thresh, kernel, demo)
-
-	# output to a raster if the output file extension is .tif (no cleaning)
-	if output[-4:] == ".tif":
-		# TODO: convert to vector, clean then rasterise
-		writeTiff(output, opened_map, geodata)
-
-	# clean the dataset and output to a vector if the output file extension is .shp
-	elif output[-4:] == ".shp":
-		cleanWriteShapefile(output, opened_map, geodata, buffer, min_area, min_ratio, 
-		      convex_hull, centroid, representative_point, exterior, interior, uid)
+		# write to a raster or vector file
+		writeOutput(output, opened_map, transform, crs, s)
 	
-	vprint("Extraction complete!")
\ No newline at end of file
+		vprint("Extraction complete!")
+		return ctx.metrics
+
+
+class Extractor:
+	"""
+	* Extract markup from any number of photographs of the same layout
+	* 
+	* The settings are fixed when the Extractor is created and the reference is prepared
+	*  once and only ever read, so one Extractor can be used from many threads at once (the
+	*  heavy OpenCV calls release the GIL). Logging and metrics are kept separately for each
+	*  call. For example:
+	* 
+	*     extractor = Extractor('map.png', thresh=100, kernel=0)
+	*     results = extractor.extract_many([('IMG_0001.jpg', 'IMG_0001.shp'), ...], workers=4)
+	"""
+	def __init__(self, reference, *, working_dpi=None, settings=None, **options):
+
+		# make sure that the requested output is valid
+		self._settings = extract_settings(settings, **options)
+		check_output_options(None, self._settings)
+
+		# read in the reference image (unless it has already been prepared)
+		with RunContext(self._settings.verbose):
+			self._reference = reference if isinstance(reference, Reference) else prepare_reference(reference, working_dpi)
+
+	@property
+	def settings(self):
+		return self._settings
+
+	@property
+	def reference(self):
+		return self._reference
+
+	def _mask(self, target):
+		"""extract the mask within the current run context"""
+		return settings_mask(self._reference, target, self._settings)
+
+	def extract_mask(self, target):
+		"""
+		* Extract the markup from a target image (file path, image bytes or numpy array)
+		* @return the binary numpy array, its affine transform and its crs
+		"""
+		with RunContext(self._settings.verbose):
+			return self._mask(target)
+
+	def extract_features(self, target):
+		"""
+		* Extract the markup from a target image (file path, image bytes or numpy array)
+		* @return a list of cleaned GeoJSON-like features and the crs
+		"""
+		s = self._settings
+		with RunContext(s.verbose):
+			opened_map, transform, crs = self._mask(target)
+			return list(iter_features(opened_map, transform, settings=s)), crs
+
+	def extract(self, target, output, label=None):
+		"""
+		* Extract the markup from a target image and write it to a .tif or .shp file
+		* @return a dict of the time (seconds) spent in each stage
+		"""
+		s = self._settings
+		check_output_options(output, s)
+		with RunContext(s.verbose, label) as ctx:
+			vprint(f"Extracting markup -> {output}")
+			opened_map, transform, crs = self._mask(target)
+			writeOutput(output, opened_map, transform, crs, s)
+			return ctx.metrics
+
+	def extract_many(self, jobs, workers=4):
+		"""
+		* Extract the markup from many target images using a pool of threads, which all
+		*  share this Extractor (and so a single copy of the reference in memory)
+		* 
+		* Parameters:
+		*     jobs: an iterable of (target, output) pairs
+		*     workers: the number of threads
+		* 
+		* @return a list of (target, output, metrics, error) tuples in the order of the jobs,
+		*  where error is None if the extraction succeeded
+		"""
+		def run(job):
+			target, output = job
+			label = target if isinstance(target, str) else None
+			try:
+				return target, output, self.extract(target, output, label), None
+			except Exception as e:
+				return target, output, None, e
+
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			return list(executor.map(run, jobs))
@@ -0,0 +1,213 @@
+"""
+* Cheap image quality pre-screen for the Paper2GIS extraction
+*
+* Every photograph is scored on a small greyscale copy (sharpness, exposure and
+*  contrast) so that blurry or badly exposed frames from a burst folder or a video
+*  can be rejected or ranked before the (expensive) SIFT registration in extract_map
+*
+* @author jonnyhuck
+"""
+
+from glob import glob
+from os import path
+from pathlib import Path
+from time import perf_counter
+from numpy import percentile
+from heapq import heappush, heappushpop
+from cv2 import COLOR_BGR2GRAY, COLOR_BGRA2GRAY, CV_64F, INTER_AREA, \
+	Laplacian, VideoCapture, cvtColor, resize
+
+from paper2gis.context import RunContext, vprint
+from paper2gis.paper2gis import read_image, run_extract, prepare_reference
+
+
+# file types that can be pre-screened
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".tif", ".tiff", ".heic", ".heif"}
+VIDEO_EXTENSIONS = {".mp4", ".mov", ".m4v", ".avi", ".mkv"}
+
+
+def is_burst(source):
+	"""
+	* Is the source a burst of frames (a folder of photographs or a video file)?
+	"""
+	return path.isdir(source) or Path(source).suffix.lower() in VIDEO_EXTENSIONS
+
+
+def quality_scores(image, max_dim=512):
+	"""
+	* Compute cheap quality scores for an image using a downscaled greyscale copy
+	*
+	* Parameters:
+	*     image: the image as a numpy array (colour or greyscale)
+	*     max_dim: the size of the longest side of the copy used for scoring
+	*
+	* @return a dict containing sharpness (variance of the Laplacian), exposure (0-1,
+	*  where 1 is a mid-grey mean), contrast (0-1, the spread between the 5th and 95th
+	*  percentiles of the histogram) and a combined score used for ranking
+	"""
+
+	# greyscale
+	if image.ndim == 3:
+		grey = cvtColor(image, COLOR_BGRA2GRAY if image.shape[2] == 4 else COLOR_BGR2GRAY)
+	else:
+		grey = image
+
+	# downscale so that scores are comparable between frames of different sizes
+	h, w = grey.shape
+	scale = max_dim / max(h, w)
+	if scale < 1:
+		grey = resize(grey, (int(w * scale), int(h * scale)), interpolation=INTER_AREA)
+
+	# blurry images have few edges, so a low variance of the Laplacian
+	sharpness = float(Laplacian(grey, CV_64F).var())
+
+	# penalise images that are too dark or too bright
+	exposure = 1 - abs(float(grey.mean()) - 127.5) / 127.5
+
+	# penalise washed out images with a narrow histogram
+	low, high = percentile(grey, (5, 95))
+	contrast = float(high - low) / 255
+
+	return {'sharpness': sharpness, 'exposure': exposure, 'contrast': contrast,
+		'score': sharpness * exposure * contrast}
+
+
+def iter_frames(source, step=1, exclude=None):
+	"""
+	* Yield (name, image) pairs from a folder of photographs or a video file. Photographs
+	*  that cannot be read are skipped with a warning
+	*
+	* Parameters:
+	*     source: path to a folder or a video file
+	*     step: only use every nth frame of a video
+	*     exclude: a file to leave out of the folder (e.g. the reference layout)
+	"""
+
+	# folder of photographs (e.g. a burst from a phone)
+	if path.isdir(source):
+		for f in sorted(glob(path.join(source, "*"))):
+			if Path(f).suffix.lower() not in IMAGE_EXTENSIONS or \
+				(exclude is not None and path.abspath(f) == path.abspath(exclude)):
+				continue
+
+			# skip unreadable (e.g. corrupt or partly copied) files rather than failing the burst
+			try:
+				image = read_image(f)
+			except Exception:
+				image = None
+			if image is None:
+				print(f"WARNING: could not read {f}, skipping")
+				continue
+			yield Path(f).stem, image
+		return
+
+	# otherwise a video file
+	if not path.isfile(source):
+		raise FileNotFoundError(f"{source} does not exist")
+	video = VideoCapture(source)
+	if not video.isOpened():
+		raise Exception('NOT A VIDEO', f"Could not open {source} as a video")
+	try:
+		i = 0
+		while True:
+
+			# only decode the frames that we are going to score
+			if i % step == 0:
+				ok, frame = video.read()
+				if not ok:
+					break
+				yield f"{Path(source).stem}_{i:05d}", frame
+			elif not video.grab():
+				break
+			i += 1
+	finally:
+		video.release()
+
+
+def select_frames(source, best_n=3, min_sharpness=0, min_contrast=0, step=1, exclude=None):
+	"""
+	* Score every frame in a burst and keep the best N
+	*
+	* Parameters:
+	*     source: path to a folder or a video file
+	*     best_n: the number of frames to keep
+	*     min_sharpness: frames below this sharpness are rejected outright
+	*     min_contrast: frames below this contrast (0-1) are rejected outright
+	*     step: only use every nth frame of a video
+	*     exclude: a file to leave out of the folder (e.g. the reference layout)
+	*
+	* @return a list of (name, image, scores) tuples (best first), the number of frames
+	*  that were scored and the number that were rejected
+	"""
+
+	# min-heap of the best frames so far, so that only N full size frames are held in memory
+	best = []
+	n_frames = 0
+	n_rejected = 0
+	for name, image in iter_frames(source, step, exclude):
+		n_frames += 1
+
+		# score the frame and reject if unusable
+		scores = quality_scores(image)
+		vprint(f"  - {name}: sharpness={scores['sharpness']:.1f}, exposure={scores['exposure']:.2f}, contrast={scores['contrast']:.2f}")
+		if scores['sharpness'] < min_sharpness or scores['contrast'] < min_contrast:
+			n_rejected += 1
+			continue
+
+		# keep if one of the best N (n_frames breaks ties without comparing arrays)
+		entry = (scores['score'], n_frames, name, image, scores)
+		if len(best) < best_n:
+			heappush(best, entry)
+		else:
+			heappushpop(best, entry)
+
+	# sort best first
+	selected = [ (name, image, scores) for _, _, name, image, scores in sorted(best, reverse=True) ]
+	return selected, n_frames, n_rejected
+
+
+def run_burst(reference, source, output='out.shp', best_n=3, min_sharpness=0, min_contrast=0,
+	step=1, verbose=False, **kwargs):
+	"""
+	* Pre-screen a burst of photographs or a video and only extract markup from the best
+	*  N frames. One output is written per registered frame, named after the frame
+	*  (e.g. out.shp -> out_IMG_0001.shp). Additional keyword arguments are passed
+	*  to run_extract
+	* @author jonnyhuck
+	* @return a list of the output files that were written
+	"""
+
+	# logging for this run only
+	with RunContext(verbose):
+		# score all of the frames
+		vprint(f"\nPre-screening frames: {source}")
+		start = perf_counter()
+		selected, n_frames, n_rejected = select_frames(source, best_n, min_sharpness, min_contrast, step,
+			reference if isinstance(reference, str) else None)
+		screen_time = perf_counter() - start
+
+		if not selected:
+			raise Exception('NO USABLE FRAMES', f"None of the {n_frames} frames in {source} passed the pre-screen")
+		vprint(f"Selected {len(selected)} of {n_frames} frames ({n_rejected} rejected) in {screen_time:.2f}s")
+
+		# register the selected frames only, against the same prepared reference
+		reference = prepare_reference(reference, kwargs.pop('working_dpi', None))
+		root, ext = path.splitext(output)
+		outputs = []
+		registration_times = []
+		for name, image, scores in selected:
+			frame_output = f"{root}_{name}{ext}"
+			try:
+				metrics = run_extract(reference, image, frame_output, verbose=verbose, **kwargs)
+				outputs.append(frame_output)
+				registration_times.append(metrics['register'])
+			except Exception as e:
+				print(f"WARNING: could not extract {name}: {e.args[-1] if e.args else e}")
+
+		# estimate the time saved by not registering the skipped frames
+		n_skipped = n_frames - len(selected)
+		mean_time = sum(registration_times) / len(registration_times) if registration_times else 0
+		saved = mean_time * n_skipped - screen_time
+		print(f"Pre-screen: registered {len(selected)} of {n_frames} frames, skipped {n_skipped} " +
+			f"(pre-screen {screen_time:.2f}s, mean registration {mean_time:.2f}s, estimated saving {saved:.2f}s)")
+		return outputs
@@ -0,0 +1,221 @@
+"""
+* Concurrent map tile fetching for the Paper2GIS map generation
+*
+* Cartopy downloads the tiles for each provider separately with a new connection per
+*  tile. Here, the tiles for every provider on the sheet (e.g. OSM and the hillshade)
+*  are fetched together by a bounded thread pool that re-uses HTTP keep-alive connections,
+*  limits the request rate per host and retries failed requests with a backoff. The
+*  results are then handed to cartopy via the PrefetchedTiles mixin
+*
+* @author jonnyhuck
+"""
+
+from io import BytesIO
+from PIL import Image
+from time import monotonic, sleep
+from urllib.parse import urlsplit
+from threading import Lock, local
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+
+
+class PrefetchedTiles:
+	"""
+	* Mixin for cartopy tile sources that serves tiles that have already been fetched
+	*  (stored in self.tiles by prefetch_tiles), falling back to the normal cartopy
+	*  download for any tile that is missing
+	*
+	* The tiles are requested from `url_template` (e.g. 'http://localhost:8000/{z}/{x}/{y}.png'
+	*  for a local tile server) if one is given, otherwise from the cartopy tile source
+	"""
+	url_template = None
+
+	def __init__(self, *args, url_template=None, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.tiles = {}
+		if url_template is not None:
+			self.url_template = url_template
+
+	def tile_url(self, tile):
+		"""get the URL of a tile"""
+		if self.url_template is None:
+			return super()._image_url(tile)
+		x, y, z = tile
+		return self.url_template.format(x=x, y=y, z=z)
+
+	def _image_url(self, tile):
+		# used by cartopy for any tile that was not prefetched
+		return self.tile_url(tile)
+
+	def get_image(self, tile):
+		data = self.tiles.get(tile)
+		if data is None:
+			return super().get_image(tile)
+		img = Image.open(BytesIO(data)).convert(self.desired_tile_form)
+		return img, self.tileextent(tile), 'lower'
+
+
+class RateLimiter:
+	"""
+	* Space out requests to a host so that there are no more than `rate` per second
+	"""
+	def __init__(self, rate):
+		self.interval = 1 / rate if rate else 0
+		self.next_time = 0
+		self.lock = Lock()
+
+	def wait(self):
+		with self.lock:
+			now = monotonic()
+			slot = max(now, self.next_time)
+			self.next_time = slot + self.interval
+		if slot > now:
+			sleep(slot - now)
+
+
+class TileFetcher:
+	"""
+	* Fetch tiles concurrently with a bounded thread pool, keep-alive connections (one per
+	*  host per thread), per-host rate limiting and retry with exponential backoff
+	*
+	* Parameters:
+	*     max_workers: the maximum number of concurrent requests
+	*     rate: the maximum number of requests per second to each host (0 for no limit)
+	*     retries: the number of times a failed request is retried
+	*     backoff: the delay (seconds) before the first retry, doubled for each subsequent retry
+	*     timeout: the socket timeout (seconds)
+	*     user_agent: the User-Agent header (required by the OSM tile usage policy)
+	"""
+
+	# responses that are worth retrying
+	RETRY_STATUS = {429, 500, 502, 503, 504}
+
+	def __init__(self, max_workers=8, rate=20, retries=3, backoff=0.5, timeout=10, user_agent="Paper2GIS"):
+		self.max_workers = max_workers
+		self.rate = rate
+		self.retries = retries
+		self.backoff = backoff
+		self.timeout = timeout
+		self.user_agent = user_agent
+		self._local = local()
+		self._limiters = {}
+		self._lock = Lock()
+
+	def _limiter(self, host):
+		"""get the rate limiter for a host"""
+		with self._lock:
+			if host not in self._limiters:
+				self._limiters[host] = RateLimiter(self.rate)
+			return self._limiters[host]
+
+	def _connection(self, scheme, netloc):
+		"""get the keep-alive connection to a host for the current thread"""
+		connections = getattr(self._local, 'connections', None)
+		if connections is None:
+			connections = self._local.connections = {}
+		key = (scheme, netloc)
+		if key not in connections:
+			Connection = HTTPSConnection if scheme == 'https' else HTTPConnection
+			connections[key] = Connection(netloc, timeout=self.timeout)
+		return connections[key]
+
+	def _drop_connection(self, scheme, netloc):
+		"""close and forget a connection (e.g. after an error) so that a new one is made"""
+		conn = self._local.connections.pop((scheme, netloc), None)
+		if conn is not None:
+			conn.close()
+
+	def get(self, url):
+		"""
+		* Fetch a single URL, retrying on connection errors and retryable responses
+		* @return the response body (bytes)
+		"""
+		parts = urlsplit(url)
+		target = parts.path + ("?" + parts.query if parts.query else "")
+		headers = {'User-Agent': self.user_agent, 'Connection': 'keep-alive'}
+
+		error = None
+		for attempt in range(self.retries + 1):
+			self._limiter(parts.netloc).wait()
+			try:
+				conn = self._connection(parts.scheme, parts.netloc)
+				conn.request('GET', target, headers=headers)
+				response = conn.getresponse()
+
+				# always read the body so that the connection can be re-used
+				body = response.read()
+
+			# broken connection or timeout, so reconnect and try again
+			except (OSError, HTTPException) as e:
+				self._drop_connection(parts.scheme, parts.netloc)
+				error = e
+
+			else:
+				if response.will_close:
+					self._drop_connection(parts.scheme, parts.netloc)
+				if response.status == 200:
+					return body
+
+				# give up straight away if the server will not have it (e.g. 404)
+				error = HTTPException(f"HTTP {response.status} for {url}")
+				if response.status not in self.RETRY_STATUS:
+					break
+
+			# wait before trying again
+			if attempt < self.retries:
+				sleep(self.backoff * 2 ** attempt)
+		raise error
+
+	def fetch(self, urls):
+		"""
+		* Fetch many URLs concurrently
+		*
+		* Parameters:
+		*     urls: a dict of {key: url}
+		*
+		* @return a dict of {key: bytes} for the successful requests and a dict of
+		*  {key: exception} for the failed ones
+		"""
+		def fetch_one(key):
+			try:
+				return key, self.get(urls[key]), None
+			except (OSError, HTTPException) as e:
+				return key, None, e
+
+		results, errors = {}, {}
+		with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+			for key, data, error in executor.map(fetch_one, urls):
+				if error is None:
+					results[key] = data
+				else:
+					errors[key] = error
+		return results, errors
+
+
+def prefetch_tiles(tilers, domain, zoom, fetcher=None):
+	"""
+	* Fetch the tiles for all of the tile sources covering a domain at once, and store
+	*  them on each (PrefetchedTiles) tile source ready for cartopy to draw
+	*
+	* Parameters:
+	*     tilers: the cartopy tile sources (with the PrefetchedTiles mixin)
+	*     domain: shapely geometry of the map extent in the crs of the tile sources
+	*     zoom: zoom level of the map tiles
+	*     fetcher: the TileFetcher to use (default settings if None)
+	*
+	* @return the number of tiles fetched and the number that failed
+	"""
+	if fetcher is None:
+		fetcher = TileFetcher(user_agent=getattr(tilers[0], 'user_agent', "Paper2GIS"))
+
+	# list the tiles needed from every source, so that they can all be requested together
+	urls = {}
+	for i, tiler in enumerate(tilers):
+		for tile in tiler.find_images(domain, zoom):
+			urls[(i, tile)] = tiler.tile_url(tile)
+
+	# fetch and hand to the tile sources
+	results, errors = fetcher.fetch(urls)
+	for (i, tile), data in results.items():
+		tilers[i].tiles[tile] = data
+	return len(results), len(errors)